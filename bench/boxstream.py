@@ -0,0 +1,60 @@
+import os
+import sys
+import time
+from nacl.secret import SecretBox
+from fern.proto.stream import BoxStream
+
+
+def increment(x: bytes):
+    # The nonce handling BoxStream used before sealing with the bindings
+    u = int.from_bytes(x, byteorder="big") + 1
+    return (u & (2**(24 * 8) - 1)).to_bytes(24, byteorder="big")
+
+
+def seal_secretbox(sbox: SecretBox, nonce: bytes, b: bytes, box_size: int):
+    boxes = []
+    for i in range(0, len(b), box_size):
+        body = b[i:i + box_size]
+        head = len(body).to_bytes(2, byteorder='big')
+        nonce = increment(nonce)
+        boxes.append(sbox.encrypt(head, nonce=nonce).ciphertext)
+        nonce = increment(nonce)
+        boxes.append(sbox.encrypt(body, nonce=nonce).ciphertext)
+    return nonce, b''.join(boxes)
+
+
+def measure(fn, seconds=1.0):
+    n = 0
+    start = time.perf_counter()
+    while True:
+        fn()
+        n += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return n / elapsed
+
+
+SIZES = (16, 256, 4096, 65535)
+
+
+def main(sizes=SIZES):
+    sbox = SecretBox(os.urandom(32))
+    for size in sizes:
+        payload = os.urandom(size)
+        box = BoxStream(sbox, bytes(24), bytes(24), conn=None, max_box_size=size)
+
+        nonce = bytes(24)
+
+        def legacy():
+            nonlocal nonce
+            nonce, _ = seal_secretbox(sbox, nonce, payload, size)
+
+        before = measure(legacy)
+        after = measure(lambda: box.seal(payload))
+        print(f'{size:>6} bytes/box: SecretBox {before:>10.0f} boxes/s '
+              f'({1e6 / before:6.2f}us), bindings {after:>10.0f} boxes/s '
+              f'({1e6 / after:6.2f}us)')
+
+
+if __name__ == '__main__':
+    main(tuple(int(x) for x in sys.argv[1:]) or SIZES)
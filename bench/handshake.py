@@ -0,0 +1,126 @@
+import os
+import sys
+import time
+import asyncio
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from fern.config import Config
+from fern.identity import Identity, LocalIdentity
+from fern.peer.server import PeerRPC
+from fern.proto.handshake import client_handshake
+from fern.proto.rpc import RPCClient
+from fern.proto.stream import RPCStream
+from fern.proto.utils import Connection
+from fern.store.log import Pool
+
+
+# Storms a loopback PeerRPC with handshakes from many concurrent
+# clients (in another process, so their own crypto doesn't count),
+# while one established session keeps making small calls.
+# Reports handshakes per second and the latency of those calls, with
+# the server doing handshake crypto inline and in its thread pool.
+
+PORT = 8993
+
+
+async def connect(id, server_id, port=PORT):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    conn = Connection(reader, writer)
+    box = await client_handshake(id, server_id, conn)
+    return conn, RPCStream(box)
+
+
+async def storm(server_id, clients, seconds):
+    ids = [LocalIdentity.generate() for _ in range(clients)]
+    done = 0
+    deadline = time.perf_counter() + seconds
+
+    async def client(id):
+        nonlocal done
+        while time.perf_counter() < deadline:
+            try:
+                conn, s = await connect(id, server_id)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # Turned away by the server's admission limits
+                await asyncio.sleep(0.01)
+                continue
+            with conn:
+                await s.goodbye()
+            done += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(client(id) for id in ids))
+    return done / (time.perf_counter() - start)
+
+
+def storm_process(server_id, clients, seconds):
+    return asyncio.run(storm(Identity.from_id(server_id), clients, seconds))
+
+
+async def ping(client, latencies, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await client.call('peer.summary', {"prefixes": [""]})
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.001)
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(len(xs) - 1, int(len(xs) * p))] if xs else float('nan')
+
+
+async def run(config, offload, clients, seconds):
+    server_id = config.get_local_identity().to_identity()
+    async with Pool(config.log_path) as pool:
+        server = PeerRPC(config, pool=pool, max_pending=clients)
+        if not offload:
+            server.executor = None
+        serving = asyncio.create_task(server.serve())
+        await asyncio.sleep(0.1)
+
+        conn, s = await connect(LocalIdentity.generate(), server_id)
+        with conn:
+            async with RPCClient(s) as client:
+                # Latency of the established session while idle, then
+                # during the storm
+                for label, n in (('idle', 0), ('storm', clients)):
+                    latencies = []
+                    stop = asyncio.Event()
+                    pinging = asyncio.create_task(ping(client, latencies, stop))
+                    if n:
+                        with ProcessPoolExecutor(1) as executor:
+                            rate = await asyncio.get_running_loop().run_in_executor(
+                                executor, storm_process, str(server_id), n, seconds)
+                    else:
+                        await asyncio.sleep(seconds)
+                        rate = 0
+                    stop.set()
+                    await pinging
+                    print(f'{"thread pool" if offload else "inline":>11} {label:>5}: '
+                          f'{rate:7.0f} handshakes/s, call latency '
+                          f'p50 {percentile(latencies, 0.5) * 1e3:6.2f}ms '
+                          f'p99 {percentile(latencies, 0.99) * 1e3:6.2f}ms')
+
+        serving.cancel()
+        await asyncio.gather(serving, return_exceptions=True)
+
+
+def main(clients=64, seconds=2.0):
+    with tempfile.TemporaryDirectory() as dir:
+        secret_path = os.path.join(dir, 'priv')
+        with open(secret_path, 'wb') as f:
+            f.write(LocalIdentity.generate().to_priv_bytes())
+        config = Config(
+            secret_path=secret_path,
+            log_path=os.path.join(dir, 'log.sqlite'),
+            local_tcp_addr="localhost:0",
+            sync_addr="127.0.0.1:%d" % PORT,
+            broadcast_addr="127.255.255.255:9219",
+        )
+        for offload in (False, True):
+            asyncio.run(run(config, offload, clients, seconds))
+
+
+if __name__ == '__main__':
+    main(*(int(x) for x in sys.argv[1:2]))
@@ -0,0 +1,335 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import platform
+import tempfile
+import subprocess
+from nacl.secret import SecretBox
+from fern.entry import Entry, build_entry, canonical_encode_json
+from fern.identity import Identity, LocalIdentity
+from fern.proto.stream import BoxStream, RPCStream
+from fern.store.log import Pool, get_last_entry_info, store_entry, transaction
+
+
+# Microbenchmarks for the hot paths. Results are written as JSON so that
+# runs from different commits can be compared:
+#
+#   python -m bench.suite --out before.json
+#   python -m bench.suite --out after.json
+#   python -m bench.suite compare before.json after.json
+#
+# Each benchmark runs its op in batches sized so that a batch takes at
+# least MIN_BATCH_NS, and percentiles are over the per-op time of each
+# batch.
+
+MIN_BATCH_NS = 100_000
+MAX_BATCH = 4096
+SIZES = (16, 1024, 65535)
+
+BENCHMARKS = {}
+
+
+def benchmark(name, max_ops=None):
+    # Registers an async setup function returning (op, teardown). op may
+    # be sync or async; teardown may be None.
+    def register(fn):
+        BENCHMARKS[name] = (fn, max_ops)
+        return fn
+    return register
+
+
+class Pipe:
+    # In-memory connection: reads return what was written
+    def __init__(self):
+        self.buf = bytearray()
+
+    async def write(self, b):
+        self.buf += b
+
+    async def read(self, n):
+        b = bytes(self.buf[:n])
+        del self.buf[:n]
+        return b
+
+
+class Sink:
+    async def write(self, b):
+        pass
+
+
+async def measure(op, seconds, max_ops=None):
+    is_async = asyncio.iscoroutinefunction(op)
+
+    async def run(n):
+        start = time.perf_counter_ns()
+        if is_async:
+            for _ in range(n):
+                await op()
+        else:
+            for _ in range(n):
+                op()
+        return time.perf_counter_ns() - start
+
+    ops = 0
+    batch = 1
+    while True:
+        elapsed = await run(batch)
+        ops += batch
+        if elapsed >= MIN_BATCH_NS or batch >= MAX_BATCH:
+            break
+        batch *= 2
+    if max_ops is not None:
+        batch = min(batch, max(1, (max_ops - ops) // 16))
+
+    samples = []
+    total_ns = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        if max_ops is not None and ops + batch > max_ops:
+            break
+        elapsed = await run(batch)
+        ops += batch
+        total_ns += elapsed
+        samples.append(elapsed / batch)
+
+    samples.sort()
+
+    def percentile(p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))] / 1e3
+
+    return {
+        "ops_per_sec": len(samples) * batch / (total_ns / 1e9) if total_ns else None,
+        "p50_us": percentile(0.5),
+        "p90_us": percentile(0.9),
+        "p99_us": percentile(0.99),
+        "batch": batch,
+        "samples": len(samples),
+    }
+
+
+# Entries and identities
+
+def sample_entry(author: LocalIdentity, seq=1, previous=None) -> Entry:
+    return build_entry(
+        author=author,
+        previous=previous,
+        sequence=seq,
+        timestamp=1600000000,
+        type='post',
+        data={"text": "hello world! " * 8, "tags": ["a", "b"]},
+    )
+
+
+@benchmark('entry.build')
+async def bench_build():
+    author = LocalIdentity.generate()
+    return (lambda: sample_entry(author)), None
+
+
+@benchmark('entry.from_json')
+async def bench_from_json():
+    d = sample_entry(LocalIdentity.generate()).to_json()
+    return (lambda: Entry.from_json(d)), None
+
+
+@benchmark('entry.verify')
+async def bench_verify():
+    entry = sample_entry(LocalIdentity.generate())
+    return entry.verify, None
+
+
+@benchmark('entry.canonical_encode_json')
+async def bench_canonical():
+    d = sample_entry(LocalIdentity.generate()).to_json()
+    del d['sig']
+    return (lambda: canonical_encode_json(d)), None
+
+
+@benchmark('identity.from_id')
+async def bench_from_id():
+    id = str(LocalIdentity.generate())
+    return (lambda: Identity.from_id(id)), None
+
+
+@benchmark('identity.parse_id')
+async def bench_parse_id():
+    id = str(LocalIdentity.generate())
+    return (lambda: Identity.parse_id(id)), None
+
+
+# Framing
+
+def box_pair(conn, size):
+    key = SecretBox(os.urandom(32))
+    writer = BoxStream(key, bytes(24), bytes(24), conn=conn, max_box_size=size)
+    reader = BoxStream(key, bytes(24), bytes(24), conn=conn, max_box_size=size)
+    return writer, reader
+
+
+for size in SIZES:
+    def register(size):
+        @benchmark(f'boxstream.write.{size}')
+        async def bench_box_write():
+            writer, _ = box_pair(Sink(), size)
+            payload = os.urandom(size)
+
+            async def op():
+                await writer.write(payload)
+            return op, None
+
+        @benchmark(f'boxstream.roundtrip.{size}')
+        async def bench_box_roundtrip():
+            writer, reader = box_pair(Pipe(), size)
+            payload = os.urandom(size)
+
+            async def op():
+                await writer.write(payload)
+                await reader.read(size)
+            return op, None
+    register(size)
+
+
+for codec in ('json', 'binary'):
+    def register(codec):
+        @benchmark(f'rpcstream.send_next.{codec}')
+        async def bench_rpc():
+            s = RPCStream(Pipe())
+            s.apply_options({"codec": codec})
+            content = sample_entry(LocalIdentity.generate()).to_wire()
+
+            async def op():
+                await s.send(1, content, is_stream=True)
+                await s.next()
+            return op, None
+    register(codec)
+
+
+# Storage
+
+STORE_OPS = 4096
+
+
+for where in ('memory', 'disk'):
+    def register(where):
+        async def open_pool():
+            if where == 'memory':
+                return None, Pool(':memory:')
+            dir = tempfile.TemporaryDirectory()
+            return dir, Pool(os.path.join(dir.name, 'log.sqlite'))
+
+        @benchmark(f'store.store_entry.{where}', max_ops=STORE_OPS)
+        async def bench_store():
+            author = LocalIdentity.generate()
+            entries = []
+            for seq in range(1, STORE_OPS + 1):
+                entries.append(sample_entry(author, seq, entries[-1].id if entries else None))
+            dir, pool = await open_pool()
+            await pool.open()
+            it = iter(entries)
+
+            async def op():
+                # One transaction per entry, like a lone append
+                async with pool.writer() as db:
+                    async with transaction(db, pool.heads):
+                        await store_entry(db, next(it), pool.heads)
+
+            async def teardown():
+                await pool.close()
+                if dir is not None:
+                    dir.cleanup()
+            return op, teardown
+
+        @benchmark(f'store.get_last_entry_info.{where}')
+        async def bench_last():
+            author = LocalIdentity.generate()
+            dir, pool = await open_pool()
+            await pool.open()
+            previous = None
+            async with pool.writer() as db:
+                async with transaction(db, pool.heads):
+                    for seq in range(1, 257):
+                        entry = sample_entry(author, seq, previous)
+                        await store_entry(db, entry, pool.heads)
+                        previous = entry.id
+
+            async def op():
+                async with pool.reader() as db:
+                    await get_last_entry_info(db, author)
+
+            async def teardown():
+                await pool.close()
+                if dir is not None:
+                    dir.cleanup()
+            return op, teardown
+    register(where)
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'],
+            capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(names, seconds):
+    results = {}
+    for name in names:
+        setup, max_ops = BENCHMARKS[name]
+        op, teardown = await setup()
+        try:
+            results[name] = await measure(op, seconds, max_ops)
+        finally:
+            if teardown is not None:
+                await teardown()
+        print(f'{name:<36} {results[name]["ops_per_sec"]:>12.0f} ops/s  '
+              f'p50 {results[name]["p50_us"]:9.2f}us  p99 {results[name]["p99_us"]:9.2f}us',
+              file=sys.stderr)
+    return results
+
+
+def compare(before_path, after_path):
+    with open(before_path) as f:
+        before = json.load(f)['results']
+    with open(after_path) as f:
+        after = json.load(f)['results']
+    for name in sorted(before.keys() & after.keys()):
+        a, b = before[name]['ops_per_sec'], after[name]['ops_per_sec']
+        print(f'{name:<36} {a:>12.0f} -> {b:>12.0f} ops/s  {(b / a - 1) * 100:+7.1f}%')
+
+
+def main(argv):
+    if argv[:1] == ['compare']:
+        compare(*argv[1:3])
+        return
+
+    parser = argparse.ArgumentParser(prog='python -m bench.suite')
+    parser.add_argument('-k', dest='filter', default='', help='only run benchmarks containing this')
+    parser.add_argument('--seconds', type=float, default=1.0, help='time per benchmark')
+    parser.add_argument('--out', help='write results here instead of stdout')
+    args = parser.parse_args(argv)
+
+    names = [name for name in BENCHMARKS if args.filter in name]
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "time": int(time.time()),
+        "seconds": args.seconds,
+        "results": asyncio.run(run(names, args.seconds)),
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+        print()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
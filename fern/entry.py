@@ -1,15 +1,27 @@
+import asyncio
 import base64
+import binascii
 import dataclasses
+import multiprocessing
 import orjson
-from typing import Union
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Iterable, List, Union
 
 from nacl.hash import sha256
 from nacl.encoding import Base64Encoder
 from fern.identity import Identity, LocalIdentity
 
 
+def json_default(obj):
+    # Lets orjson encode bytes the way entries always have: as base64
+    if isinstance(obj, (bytes, bytearray, memoryview)):
+        return base64.b64encode(obj).decode('ascii')
+    raise TypeError
+
+
 def canonical_encode_json(data) -> bytes:
-    return orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    # bytes encode as base64, as with Entry.encode_data
+    return orjson.dumps(data, option=orjson.OPT_SORT_KEYS, default=json_default)
 
 
 def build_entry(author: LocalIdentity,
@@ -46,6 +58,9 @@ def build_entry(author: LocalIdentity,
     )
 
 
+ENTRY_FIELDS = {"prev", "seq", "author", "timestamp", "type", "data", "sig"}
+
+
 @dataclasses.dataclass(frozen=True, eq=True)
 class Entry:
     id: str
@@ -58,7 +73,7 @@ class Entry:
     signature: str
 
     @staticmethod
-    def decode_data(data: Union[dict, str]):
+    def decode_data(data: Union[dict, str, bytes]):
         return (base64.b64decode(data)
                 if isinstance(data, str)
                 else data)
@@ -71,6 +86,19 @@ class Entry:
                 if isinstance(data, bytes)
                 else data)
 
+    def to_wire(self):
+        # Like to_json, but leaves bytes data as-is for codecs that can
+        # carry it; JSON encodes it as base64 just like to_json.
+        return {
+            "prev": self.previous,
+            "seq": self.sequence,
+            "author":   str(self.author),
+            "timestamp": self.timestamp,
+            "type": self.type,
+            "data": self.data,
+            "sig": self.signature,
+        }
+
     def to_json(self):
         return {
             "prev": self.previous,
@@ -84,6 +112,12 @@ class Entry:
 
     @staticmethod
     def from_json(data):
+        # Also accepts to_wire() dicts, whose bytes data hashes as base64.
+        # The id hashes the whole dict but the signature only covers
+        # these fields, so anything else would give a signed entry a
+        # different id.
+        if data.keys() != ENTRY_FIELDS:
+            raise ValueError("entry has missing or unexpected fields")
         id = sha256(canonical_encode_json(data), encoder=Base64Encoder)
         return Entry(
             id=f'%{id.decode("ascii")}',
@@ -107,3 +141,52 @@ class Entry:
                 return False
 
         return self.author.verify(msg, sig)
+
+
+VERIFY_CHUNK_SIZE = 512
+VERIFY_INLINE_LIMIT = 16
+
+_verify_pool = None
+
+
+def get_verify_pool() -> Executor:
+    global _verify_pool
+    if _verify_pool is None:
+        # Not fork: by now the node has aiosqlite threads running
+        _verify_pool = ProcessPoolExecutor(mp_context=multiprocessing.get_context('forkserver'))
+    return _verify_pool
+
+
+def _verify_chunk(chunk: List[dict]) -> List[bool]:
+    # Runs in a worker process, so entries travel as their JSON form
+    results = []
+    for d in chunk:
+        sig = d.pop('sig')
+        try:
+            author = Identity.from_id(d['author'])
+            results.append(author.verify(canonical_encode_json(d), sig))
+        except (ValueError, binascii.Error):
+            results.append(False)
+    return results
+
+
+async def verify_many(entries: Iterable[Entry],
+                      executor: Union[None, Executor] = None,
+                      chunk_size: int = VERIFY_CHUNK_SIZE) -> List[bool]:
+    # Results are in input order. Anything but tiny batches is split
+    # across the executor (a shared process pool by default) so that
+    # the event loop can keep serving other connections.
+    chunk = [e.to_json() for e in entries]
+    if len(chunk) <= VERIFY_INLINE_LIMIT:
+        return _verify_chunk(chunk)
+
+    loop = asyncio.get_running_loop()
+    executor = executor or get_verify_pool()
+    futures = [
+        loop.run_in_executor(executor, _verify_chunk, chunk[i:i + chunk_size])
+        for i in range(0, len(chunk), chunk_size)
+    ]
+    results = []
+    for r in await asyncio.gather(*futures):
+        results.extend(r)
+    return results
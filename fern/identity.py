@@ -1,32 +1,58 @@
 import base64
+from functools import lru_cache
 from nacl.signing import VerifyKey, SigningKey
 from nacl.encoding import Base64Encoder
 from nacl.exceptions import BadSignatureError
 
 
+INTERN_CACHE_SIZE = 4096
+
+
 class Identity:
-    __slots__ = ('pub',)
+    __slots__ = ('pub', '_id', '_curve25519_pub')
 
     def __init__(self, pub: VerifyKey):
         self.pub = pub
+        self._id = None
+        self._curve25519_pub = None
 
     def __hash__(self):
         return hash(self.pub)
 
     @classmethod
     def from_id(cls, pub_b64: str):
+        return intern_id(pub_b64)
+
+    @classmethod
+    def from_raw_bytes(cls, pub: bytes):
+        return intern_id('@' + base64.b64encode(pub).decode('ascii'))
+
+    @classmethod
+    def parse_id(cls, pub_b64: str):
         if len(pub_b64) != 45 or not pub_b64.startswith('@'):
             raise ValueError("Invalid id string")
-        return cls(pub=VerifyKey(
+        id = cls(pub=VerifyKey(
             pub_b64[1:],
             encoder=Base64Encoder,
         ))
+        id._id = pub_b64
+        return id
 
     def to_bytes(self):
-        return b'@' + self.pub.encode(Base64Encoder)
+        return str(self).encode('ascii')
+
+    def to_raw_bytes(self) -> bytes:
+        return self.pub.encode()
+
+    def curve25519_public_key(self) -> bytes:
+        if self._curve25519_pub is None:
+            self._curve25519_pub = self.pub.to_curve25519_public_key().encode()
+        return self._curve25519_pub
 
     def __str__(self):
-        return self.to_bytes().decode('ascii')
+        if self._id is None:
+            self._id = '@' + self.pub.encode(Base64Encoder).decode('ascii')
+        return self._id
 
     def __repr__(self):
         return f'<{self.__class__.__name__} [{str(self)}]>'
@@ -43,17 +69,33 @@ class Identity:
             return False
 
 
+@lru_cache(maxsize=INTERN_CACHE_SIZE)
+def intern_id(pub_b64: str) -> Identity:
+    # Identities are immutable once parsed, so the same instance (along
+    # with its cached string form and Curve25519 key) can be shared.
+    return Identity.parse_id(pub_b64)
+
+
 class LocalIdentity(Identity):
-    __slots__ = ('pub', 'priv')
+    __slots__ = ('priv', '_curve25519_priv')
 
     def __init__(self, priv: SigningKey):
+        super().__init__(priv.verify_key)
         self.priv = priv
-        self.pub = priv.verify_key
+        self._curve25519_priv = None
 
     @classmethod
     def from_id(cls, pub_b64: str):
         raise NotImplementedError
 
+    @classmethod
+    def from_raw_bytes(cls, pub: bytes):
+        raise NotImplementedError
+
+    @classmethod
+    def parse_id(cls, pub_b64: str):
+        raise NotImplementedError
+
     @classmethod
     def from_bytes(cls, priv_b64: bytes):
         return cls(SigningKey(priv_b64, encoder=Base64Encoder))
@@ -65,10 +107,15 @@ class LocalIdentity(Identity):
     def to_priv_bytes(self):
         return self.priv.encode(Base64Encoder)
 
+    def curve25519_private_key(self) -> bytes:
+        if self._curve25519_priv is None:
+            self._curve25519_priv = self.priv.to_curve25519_private_key().encode()
+        return self._curve25519_priv
+
     def sign(self, data: bytes) -> str:
         return (self.priv.sign(data, encoder=Base64Encoder)
                 .signature
                 .decode('ascii'))
 
     def to_identity(self) -> Identity:
-        return Identity(self.pub)
+        return Identity.from_id(str(self))
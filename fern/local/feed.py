@@ -1,40 +1,109 @@
+import asyncio
 from datetime import datetime
-from fern.proto.rpc import Response, Request
+from fern.proto.rpc import Response, Request, StreamContent
 from fern.local.server import expose, Handler
-from fern.store.log import get_last_entry_info, transaction, store_entry
-from fern.entry import build_entry
-
-
-async def store_entry_prefill(db, id, type, data):
-    previous, seq = await get_last_entry_info(db, id.to_identity())
-    async with transaction(db):
-        entry = build_entry(
-            author=id,
-            previous=previous,
-            sequence=seq + 1,
-            timestamp=int(datetime.utcnow().timestamp()),
-            type=type,
-            data=data,
-        )
-        await store_entry(db, entry)
-    return entry
+from fern.identity import Identity, LocalIdentity
+from fern.store.log import Pool, transaction, store_entries, get_entries
+from fern.entry import Entry, build_entry
+
+
+class AppendQueue:
+    # Collects appends to the local feed for up to `max_delay` seconds or
+    # `max_batch` entries, then chains, signs and writes them in a single
+    # transaction so that concurrent appends share one commit.
+    def __init__(self, pool: Pool, id: LocalIdentity, max_batch=256, max_delay=0.002):
+        self.pool = pool
+        self.id = id
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.pending = []
+        self.timer = None
+        self.writes = set()
+
+    def append(self, type: str, data) -> 'asyncio.Future[Entry]':
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self.pending.append((type, data, fut))
+        if len(self.pending) >= self.max_batch:
+            self.flush()
+        elif self.timer is None:
+            self.timer = loop.call_later(self.max_delay, self.flush)
+        return fut
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        batch, self.pending = self.pending, []
+        if batch:
+            # The writer lock is FIFO, so batches commit in order
+            task = asyncio.ensure_future(self.write(batch))
+            self.writes.add(task)
+            task.add_done_callback(self.writes.discard)
+
+    async def write(self, batch):
+        heads = self.pool.heads
+        entries = []
+        waiters = []
+        async with self.pool.writer() as db:
+            try:
+                async with transaction(db, heads):
+                    previous, seq = heads.get_staged(str(self.id))
+                    timestamp = int(datetime.utcnow().timestamp())
+                    for type, data, fut in batch:
+                        if fut.done():
+                            continue
+                        try:
+                            entry = build_entry(
+                                author=self.id,
+                                previous=previous,
+                                sequence=seq + 1,
+                                timestamp=timestamp,
+                                type=type,
+                                data=data,
+                            )
+                        except Exception as exc:
+                            # e.g. too big, or data the encoder can't take
+                            fut.set_exception(exc)
+                            continue
+                        previous, seq = entry.id, entry.sequence
+                        entries.append(entry)
+                        waiters.append(fut)
+                    await store_entries(db, entries, heads)
+            except Exception as exc:
+                for _, _, fut in batch:
+                    if not fut.done():
+                        fut.set_exception(exc)
+                return
+
+        for fut, entry in zip(waiters, entries):
+            if not fut.done():
+                fut.set_result(entry)
 
 
 class FeedHandler(Handler):
     prefix = 'feed'
+    max_batch = 256
+    max_delay = 0.002
+    history_batch_size = 128
+
+    def __init__(self, config, pool):
+        super().__init__(config, pool)
+        self.appends = AppendQueue(
+            pool=pool,
+            id=config.get_local_identity(),
+            max_batch=self.max_batch,
+            max_delay=self.max_delay,
+        )
 
     @expose
     async def follow(self, stream, req):
         assert isinstance(req.args['id'], str)
 
-        id = self.config.get_local_identity()
-        async with self.get_db() as db:
-            entry = await store_entry_prefill(
-                db=db,
-                id=id,
-                type='follow',
-                data=req.args['id'].encode('utf-8'),
-            )
+        entry = await self.appends.append(
+            type='follow',
+            data=req.args['id'].encode('utf-8'),
+        )
 
         res = Response(id=req.id, content={"id": entry.id})
         await res.send(stream)
@@ -43,30 +112,26 @@ class FeedHandler(Handler):
     async def unfollow(self, stream, req):
         assert isinstance(req.args['id'], str)
 
-        id = self.config.get_local_identity()
-        async with self.get_db() as db:
-            entry = await store_entry_prefill(
-                db=db,
-                id=id,
-                type='unfollow',
-                data=req.args['id'].encode('utf-8'),
-            )
+        entry = await self.appends.append(
+            type='unfollow',
+            data=req.args['id'].encode('utf-8'),
+        )
 
         res = Response(id=req.id, content={"id": entry.id})
         await res.send(stream)
 
     @expose
     async def post(self, stream, req: Request):
-        assert 'data' in req.args and isinstance(req.args['data'], str)
-
-        id = self.config.get_local_identity()
-        async with self.get_db() as db:
-            entry = await store_entry_prefill(
-                db=db,
-                id=id,
-                type='post',
-                data=req.args['data'].encode('utf-8'),
-            )
+        assert 'data' in req.args and isinstance(req.args['data'], (str, bytes))
+
+        entry = await self.appends.append(
+            type='post',
+            data=(
+                req.args['data'].encode('utf-8')
+                if isinstance(req.args['data'], str)
+                else req.args['data']
+            ),
+        )
 
         res = Response(id=req.id, content={"id": entry.id})
         await res.send(stream)
@@ -74,39 +139,63 @@ class FeedHandler(Handler):
     @expose
     async def add(self, stream, req: Request):
         assert 'type' in req.args and isinstance(req.args['type'], str)
-        assert 'data' in req.args and isinstance(req.args['data'], (str, dict))
-
-        id = self.config.get_local_identity()
-        async with self.get_db() as db:
-            entry = await store_entry_prefill(
-                db=db,
-                id=id,
-                type=req.args['type'],
-                data=(
-                    req.args['data'].encode('utf-8')
-                    if isinstance(req.args['data'], str)
-                    else req.args['data']
-                ),
-            )
+        assert 'data' in req.args and isinstance(req.args['data'], (str, bytes, dict))
+
+        entry = await self.appends.append(
+            type=req.args['type'],
+            data=(
+                req.args['data'].encode('utf-8')
+                if isinstance(req.args['data'], str)
+                else req.args['data']
+            ),
+        )
 
         res = Response(id=req.id, content={"id": entry.id})
         await res.send(stream)
 
     @expose
     async def digest(self, stream, req: Request):
-        async with self.get_db() as db:
-            cursor = await db.execute(
-                'SELECT id, author, seq FROM log ORDER BY author, seq',
-            )
-            digest = {}
-            async for id, author, seq in cursor:
-                if author not in digest:
-                    if seq == 1:
-                        digest[author] = (seq, id)
-                    continue
-                prev_seq, _ = digest[author]
-                if prev_seq == seq - 1:
-                    digest[author] = (seq, id)
-
-            res = Response(id=req.id, content={k: id for k, (_, id) in digest.items()})
-            await res.send(stream)
+        # With {"prefixes": [...]}, expands nodes of the heads summary
+        # instead (see fern.store.summary), starting from [""].
+        if 'prefixes' in req.args:
+            content = self.pool.heads.summary.expand(req.args['prefixes'])
+        else:
+            content = self.pool.heads.digest()
+        res = Response(id=req.id, content=content)
+        await res.send(stream)
+
+    @expose
+    async def history(self, stream, req: Request):
+        # Streams entries with seq > args.seq (default 0) in seq order.
+        # The final frame carries the last seq sent, so a client can
+        # resume from there.
+        author = str(Identity.from_id(req.args.get('id', str(self.appends.id))))
+        since = req.args.get('seq', 0)
+        type = req.args.get('type')
+        limit = req.args.get('limit')
+        assert isinstance(since, int)
+        assert type is None or isinstance(type, str)
+        assert limit is None or (isinstance(limit, int) and limit >= 0)
+
+        remaining = limit
+        while remaining is None or remaining > 0:
+            n = (self.history_batch_size
+                 if remaining is None
+                 else min(remaining, self.history_batch_size))
+            # Only hold on to a reader for one batch at a time
+            async with self.pool.reader() as db:
+                entries = await get_entries(db, author, since, n, type=type)
+            stream.cork()
+            try:
+                for entry in entries:
+                    await StreamContent(id=req.id, content=entry.to_wire()).send(stream)
+            finally:
+                await stream.uncork()
+            if entries:
+                since = entries[-1].sequence
+            if len(entries) < n:
+                break
+            if remaining is not None:
+                remaining -= len(entries)
+
+        await StreamContent(id=req.id, content={"seq": since}, is_eos=True).send(stream)
@@ -1,12 +1,13 @@
 import asyncio
 from functools import wraps
-from contextlib import asynccontextmanager
+from typing import Optional
 
 from fern.config import Config
-from fern.proto.utils import Connection, Deadline
+from fern.proto.protocol import RPCProtocol
 from fern.proto.stream import RPCStream
 from fern.proto.rpc import decode_frame, Request, Response
-from fern.store.log import get_db, init_db
+from fern.proto.utils import ProtocolError
+from fern.store.log import Pool
 
 
 def expose(method):
@@ -26,14 +27,9 @@ def expose(method):
 class Handler:
     prefix = ''
 
-    def __init__(self, config):
+    def __init__(self, config, pool: Pool):
         self.config = config
-
-    @asynccontextmanager
-    async def get_db(self):
-        async with get_db(self.config.log_path) as db:
-            await init_db(db)
-            yield db
+        self.pool = pool
 
     def register(self, handlers):
         for name in dir(self):
@@ -44,12 +40,34 @@ class Handler:
                 handlers[name] = fn
 
 
+class OptionsHandler(Handler):
+    prefix = 'rpc'
+
+    @expose
+    async def options(self, s: RPCStream, req: Request):
+        accepted = s.select_options(req.args)
+        await Response(id=req.id, content=accepted).send(s)
+        s.apply_options(accepted)
+
+
 class LocalRPC:
-    def __init__(self, config: Config, handlers=[]):
+    def __init__(self,
+                 config: Config,
+                 handlers=[],
+                 readers=4,
+                 max_concurrency=16,
+                 max_queued=64,
+                 timeout=2,
+                 pool: Optional[Pool] = None):
         self.config = config
+        self.max_concurrency = max_concurrency
+        self.max_queued = max_queued
+        self.timeout = timeout
+        # Servers running side by side should share one pool
+        self.pool = pool if pool is not None else Pool(config.log_path, readers=readers)
         self.handlers = {}
-        for handler in handlers:
-            handler(self.config).register(self.handlers)
+        for handler in [OptionsHandler, *handlers]:
+            handler(self.config, self.pool).register(self.handlers)
 
     async def no_handler(self, s: RPCStream, req: Request):
         r = Response(id=req.id,
@@ -57,25 +75,95 @@ class LocalRPC:
                      is_error=True)
         await r.send(s)
 
-    async def serve_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
-        conn = Connection(reader, writer)
-        rpc_stream = RPCStream(Deadline(conn))
-        with conn:
+    async def busy(self, s: RPCStream, req: Request):
+        r = Response(id=req.id,
+                     content={"err": "too many requests"},
+                     is_error=True)
+        await r.send(s)
+
+    async def dispatch(self, f, s: RPCStream, req: Request, limit: Optional[asyncio.Semaphore] = None):
+        try:
+            if limit is None:
+                await f(s, req)
+            else:
+                async with limit:
+                    await f(s, req)
+        except Exception as exc:
+            # The client has already been sent an error response
+            asyncio.get_running_loop().call_exception_handler({
+                'message': "exception in handler for '%s'" % req.name,
+                'exception': exc,
+            })
+
+    async def next_request(self, rpc_stream: RPCStream, tasks) -> Optional[Request]:
+        # Only time out while the client is idle: a client waiting on a
+        # slow handler (or a long stream) has no reason to send anything.
+        next_frame = asyncio.create_task(rpc_stream.next())
+        try:
+            while True:
+                done, _ = await asyncio.wait((next_frame,), timeout=self.timeout)
+                if done:
+                    break
+                if not tasks:
+                    return None
+        finally:
+            next_frame.cancel()
+
+        frame = next_frame.result()
+        if not frame.alive:
+            return None
+        try:
+            return decode_frame(frame, is_server=True)
+        except (KeyError, TypeError) as exc:
+            raise ProtocolError("malformed request") from exc
+
+    async def room(self, rpc_stream: RPCStream, tasks):
+        # Once max_queued requests are waiting for a handler slot, stop
+        # reading until one finishes. Not while a handler waits on stream
+        # credit though, since only reading brings credit in.
+        while (len(tasks) >= self.max_concurrency + self.max_queued
+               and not rpc_stream.waiters):
+            blocked = asyncio.ensure_future(rpc_stream.blocked.wait())
+            try:
+                await asyncio.wait([*tasks, blocked], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                blocked.cancel()
+
+    async def serve_client(self, rpc_stream: RPCStream):
+        # Handler slots are taken once a request has been read, so that
+        # reading carries on while handlers wait on stream credit.
+        # Requests beyond max_queued then get turned away rather than
+        # read into an unbounded queue.
+        limit = asyncio.Semaphore(self.max_concurrency)
+        tasks = set()
+        try:
             while True:
-                frame = await rpc_stream.next()
-                if not frame.alive:
+                await self.room(rpc_stream, tasks)
+                req = await self.next_request(rpc_stream, tasks)
+                if req is None:
                     break
 
-                # find the appropriate handler
-                req = decode_frame(frame, is_server=True)
-                f = self.handlers.get(req.name, self.no_handler)
-                await f(rpc_stream, req)
+                if len(tasks) >= self.max_concurrency + self.max_queued:
+                    # Doesn't wait for a slot
+                    task = asyncio.create_task(self.dispatch(self.busy, rpc_stream, req))
+                else:
+                    # find the appropriate handler
+                    f = self.handlers.get(req.name, self.no_handler)
+                    task = asyncio.create_task(self.dispatch(f, rpc_stream, req, limit))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
     async def serve(self):
         host, port = self.config.local_tcp_addr.rsplit(':', 1)
-        server = await asyncio.start_server(
-            self.serve_client,
-            host=host,
-            port=int(port),
-        )
-        await server.serve_forever()
+        loop = asyncio.get_running_loop()
+        async with self.pool:
+            server = await loop.create_server(
+                lambda: RPCProtocol(self.serve_client, timeout=self.timeout),
+                host=host,
+                port=int(port),
+            )
+            await server.serve_forever()
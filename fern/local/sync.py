@@ -1,8 +1,7 @@
-import json
-import base64
 from fern.identity import Identity
 from fern.proto.stream import RPCStream
 from fern.proto.rpc import Response, Request
+from fern.store.log import get_follows
 from fern.local.server import Handler, expose
 
 
@@ -11,21 +10,19 @@ class SyncHandler(Handler):
 
     @expose
     async def follows(self, s: RPCStream, r: Request):
-        id = r.args.get('id', str(self.config.get_local_identity()))
-        id = Identity.from_id(id)
+        # Either {"id": author} -> [target], or {"ids": [author]} -> {author: [target]}
+        if 'ids' in r.args:
+            assert isinstance(r.args['ids'], list)
+            ids = [str(Identity.from_id(id)) for id in r.args['ids']]
+        else:
+            id = r.args.get('id', str(self.config.get_local_identity()))
+            ids = [str(Identity.from_id(id))]
 
-        async with self.get_db() as db:
-            cursor = await db.execute(
-                'SELECT type, data FROM log WHERE log.author = ? AND '
-                '(log.type = "follow" OR log.type = "unfollow")',
-                (str(id),)
-            )
-            follows = set()
-            async for type, data in cursor:
-                if type == 'follow':
-                    follows.add(base64.b64decode(json.loads(data)).decode('ascii'))
-                elif type == 'unfollow':
-                    follows.discard(base64.b64decode(json.loads(data)).decode('ascii'))
+        async with self.pool.reader() as db:
+            follows = await get_follows(db, ids)
 
-        res = Response(id=r.id, content=list(follows))
+        res = Response(
+            id=r.id,
+            content=follows if 'ids' in r.args else follows[ids[0]],
+        )
         await res.send(s)
@@ -0,0 +1,176 @@
+import time
+import random
+import socket
+import asyncio
+import binascii
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
+
+from fern.config import Config
+from fern.identity import Identity
+
+
+@dataclass
+class Peer:
+    id: Identity
+    host: str
+    port: int
+    last_seen: float
+    failures: int = 0
+    retry_at: float = 0
+
+
+class PeerTable:
+    # Peers we've heard announce themselves, keyed by id. Peers that
+    # fail are held back for an exponentially growing, jittered delay,
+    # and peers that stop announcing are forgotten after `expiry`.
+    def __init__(self, expiry=60, base_backoff=1, max_backoff=300):
+        self.expiry = expiry
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.peers: Dict[str, Peer] = {}
+
+    def seen(self, id: Identity, host: str, port: int) -> bool:
+        # Returns whether the peer is new or has moved
+        now = time.monotonic()
+        peer = self.peers.get(str(id))
+        if peer is None:
+            self.peers[str(id)] = Peer(id=id, host=host, port=port, last_seen=now)
+            return True
+        peer.last_seen = now
+        if (peer.host, peer.port) != (host, port):
+            peer.host, peer.port = host, port
+            peer.failures, peer.retry_at = 0, 0
+            return True
+        return False
+
+    def failed(self, id: Identity):
+        peer = self.peers.get(str(id))
+        if peer is None:
+            return
+        delay = min(self.max_backoff, self.base_backoff * 2 ** peer.failures)
+        peer.failures += 1
+        peer.retry_at = time.monotonic() + delay * random.uniform(0.5, 1)
+
+    def succeeded(self, id: Identity):
+        peer = self.peers.get(str(id))
+        if peer is not None:
+            peer.failures, peer.retry_at = 0, 0
+
+    def expire(self):
+        cutoff = time.monotonic() - self.expiry
+        for key in [key for key, peer in self.peers.items() if peer.last_seen < cutoff]:
+            del self.peers[key]
+
+    def ready(self) -> List[Peer]:
+        # Peers that aren't backing off
+        self.expire()
+        now = time.monotonic()
+        return [peer for peer in self.peers.values() if peer.retry_at <= now]
+
+
+class Discovery(asyncio.DatagramProtocol):
+    # Announces us on config.broadcast_addr as "host:port:fern:id", with
+    # the port taken from config.sync_addr, and fills a PeerTable from
+    # everyone else's announcements. Broadcasts go out every `interval`
+    # seconds give or take `jitter`, so nodes started together drift
+    # apart, and never more than once per `min_interval`, even when new
+    # peers prompt an early one so they learn about us quickly.
+    def __init__(self,
+                 config: Config,
+                 table: Optional[PeerTable] = None,
+                 interval=5.0,
+                 jitter=0.25,
+                 min_interval=1.0,
+                 on_peer: Optional[Callable[[Peer], None]] = None):
+        self.config = config
+        self.table = table if table is not None else PeerTable()
+        self.interval = interval
+        self.jitter = jitter
+        self.min_interval = min_interval
+        self.on_peer = on_peer
+
+        id = str(config.get_local_identity())
+        host, port = config.sync_addr.rsplit(':', 1)
+        if host in ('0.0.0.0', '::'):
+            host = ''
+        self.announcement = f'{host}:{port}:fern:{id}'.encode('ascii')
+        # Our own packets are recognised by their tail alone
+        self.suffix = f':fern:{id}'.encode('ascii')
+        # Raw packet -> when we last handled it, so repeats are dropped
+        # without being parsed
+        self.recent: Dict[bytes, float] = {}
+
+        self.transport = None
+        self.last_broadcast = 0
+        self.wakeup = None
+
+    def datagram_received(self, data: bytes, addr):
+        if data.endswith(self.suffix):
+            return
+        now = time.monotonic()
+        if now - self.recent.get(data, -self.min_interval) < self.min_interval:
+            return
+        if len(self.recent) > 4 * len(self.table.peers) + 64:
+            self.recent.clear()
+        self.recent[data] = now
+
+        parts = data.split(b':', 3)
+        if len(parts) != 4 or parts[2] != b'fern':
+            return
+        try:
+            host = parts[0].decode('ascii') or addr[0]
+            port = int(parts[1])
+            id = Identity.from_id(parts[3].decode('ascii'))
+        except (ValueError, UnicodeDecodeError, binascii.Error):
+            return
+
+        if self.table.seen(id, host, port):
+            self.announce_soon()
+            if self.on_peer is not None:
+                self.on_peer(self.table.peers[str(id)])
+
+    def announce_soon(self):
+        if self.wakeup is not None and not self.wakeup.is_set():
+            self.wakeup.set()
+
+    def broadcast(self, sock: socket.socket, addr):
+        try:
+            sock.sendto(self.announcement, addr)
+        except OSError:
+            # e.g. the network is down; try again next time round
+            pass
+        self.last_broadcast = time.monotonic()
+
+    async def serve(self):
+        host, port = self.config.broadcast_addr.rsplit(':', 1)
+        addr = (host, int(port))
+        loop = asyncio.get_running_loop()
+
+        recv = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        recv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        recv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        recv.bind(addr)
+        self.transport, _ = await loop.create_datagram_endpoint(lambda: self, sock=recv)
+
+        send = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        send.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        send.setblocking(False)
+
+        self.wakeup = asyncio.Event()
+        try:
+            while True:
+                self.broadcast(send, addr)
+                delay = self.interval * random.uniform(1 - self.jitter, 1 + self.jitter)
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                self.wakeup.clear()
+                # Early announcements still respect min_interval
+                wait = self.last_broadcast + self.min_interval - time.monotonic()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+        finally:
+            self.transport.close()
+            send.close()
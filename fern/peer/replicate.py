@@ -0,0 +1,320 @@
+import asyncio
+import hashlib
+import weakref
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+from fern.entry import Entry, verify_many
+from fern.identity import Identity, LocalIdentity
+from fern.local.server import Handler, expose
+from fern.proto.handshake import client_handshake, TicketCache
+from fern.proto.rpc import negotiate, Request, Response, RPCClient, StreamContent
+from fern.proto.stream import RPCStream
+from fern.proto.utils import Connection, Deadline
+from fern.store.log import Pool, get_entries, get_follows, ingest_entries, transaction
+from fern.store.summary import reconcile, Summary
+
+
+# Options offered to the peer when connecting
+SYNC_OPTIONS = {"codecs": ["binary"], "compression": ["zlib"], "window": 16}
+
+# Entries per frame when streaming, and per verify-and-ingest batch
+SEND_BATCH_SIZE = 256
+INGEST_BATCH_SIZE = 1024
+
+
+async def wanted_authors(pool: Pool, id: str) -> List[str]:
+    # Feeds we replicate: our own, plus everyone we follow
+    async with pool.reader() as db:
+        follows = await get_follows(db, [id])
+    return [id, *follows[id]]
+
+
+def heads_summary(pool: Pool, authors: Iterable[str]) -> Summary:
+    # Heads summary over just the given feeds. Sessions use the feeds
+    # both sides want, so that the two trees only differ where heads do
+    # and walking ours tells a peer nothing about the rest of what we hold.
+    summary = Summary()
+    for author in authors:
+        _, seq = pool.heads.get(author)
+        if seq:
+            summary.update(author, 0, seq)
+    return summary
+
+
+def authors_hash(authors: Iterable[str]) -> str:
+    return hashlib.blake2b('\n'.join(sorted(authors)).encode('utf-8'), digest_size=16).hexdigest()
+
+
+class StaleShare(Exception):
+    # The peer summarised a different set of feeds than the one we agreed on
+    pass
+
+
+async def ingest(pool: Pool, entries: List[Entry]) -> Dict[str, Tuple[int, int]]:
+    # Verifies entries off the event loop, then stores whatever extends
+    # our feeds in one transaction. Invalid entries are dropped, which
+    # also stops their author's run at that point.
+    valid = await verify_many(entries)
+    entries = [entry for entry, ok in zip(entries, valid) if ok]
+    if not entries:
+        return {}
+    async with pool.writer() as db:
+        async with transaction(db, pool.heads):
+            return await ingest_entries(db, entries, pool.heads)
+
+
+async def read_entries(pool: Pool, since: Dict[str, int], batch_size=SEND_BATCH_SIZE):
+    # Yields lists of up to batch_size entries: every entry past
+    # since[author], author by author and in seq order within each.
+    batch = []
+    for author, seq in since.items():
+        while True:
+            async with pool.reader() as db:
+                entries = await get_entries(db, author, seq, batch_size)
+            batch.extend(entries)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+            if len(entries) < batch_size:
+                break
+            seq = entries[-1].sequence
+    if batch:
+        yield batch
+
+
+class PeerHandler(Handler):
+    # Replication between nodes. The connecting side drives a session:
+    # it tells us which feeds it wants once, and we reply with those we
+    # want too. It then finds which heads differ by walking our heads
+    # summary over just those shared feeds, sends its heads for them, we
+    # reply with ours where they differ, and it fetches what it's missing
+    # and pushes what we're missing. Each side only shares and accepts
+    # the feeds it wants itself.
+    prefix = 'peer'
+
+    def __init__(self, config, pool):
+        super().__init__(config, pool)
+        self.id = str(config.get_local_identity())
+        # connection -> (the feeds it wants, (heads summary root, hash of
+        # the shared feeds, their summary) or None)
+        self.shares = weakref.WeakKeyDictionary()
+
+    async def shared_authors(self, theirs: Set[str]) -> Set[str]:
+        return theirs.intersection(await wanted_authors(self.pool, self.id))
+
+    async def shared_summary(self, s: RPCStream) -> Tuple[str, Summary]:
+        # Rebuilt whenever any head moves. That covers our follows
+        # changing too, since they come from our own feed.
+        theirs, cached = self.shares.get(s, (set(), None))
+        root = self.pool.heads.summary.root()
+        if cached is None or cached[0] != root:
+            shared = await self.shared_authors(theirs)
+            cached = (root, authors_hash(shared), heads_summary(self.pool, shared))
+            self.shares[s] = (theirs, cached)
+        return cached[1], cached[2]
+
+    @expose
+    async def share(self, s: RPCStream, req: Request):
+        # {"authors": [...]} -> {"authors": [...]}: of the feeds the peer
+        # wants, those we want too. Later summaries on this connection
+        # cover just those.
+        theirs = req.args['authors']
+        assert isinstance(theirs, list) and all(isinstance(a, str) for a in theirs)
+        theirs = set(theirs)
+        self.shares[s] = (theirs, None)
+        shared = await self.shared_authors(theirs)
+        await Response(id=req.id, content={"authors": sorted(shared)}).send(s)
+
+    @expose
+    async def summary(self, s: RPCStream, req: Request):
+        # {"prefixes": [...]} -> {"shared": hash of the shared feeds,
+        # "nodes": {prefix: [child hash] or {author: seq}}}
+        shared, summary = await self.shared_summary(s)
+        content = {"shared": shared, "nodes": summary.expand(req.args['prefixes'])}
+        await Response(id=req.id, content=content).send(s)
+
+    @expose
+    async def heads(self, s: RPCStream, req: Request):
+        # {"heads": {author: seq}} -> {"heads": {author: seq}}
+        theirs = req.args['heads']
+        assert isinstance(theirs, dict)
+        heads = {}
+        for author in await wanted_authors(self.pool, self.id):
+            if author in theirs:
+                _, seq = self.pool.heads.get(author)
+                if seq != theirs[author]:
+                    heads[author] = seq
+        await Response(id=req.id, content={"heads": heads}).send(s)
+
+    @expose
+    async def fetch(self, s: RPCStream, req: Request):
+        # {"since": {author: seq}} streams {"entries": [...]} frames
+        since = req.args['since']
+        assert isinstance(since, dict)
+        assert all(isinstance(seq, int) for seq in since.values())
+        wanted = set(await wanted_authors(self.pool, self.id))
+        since = {author: seq for author, seq in since.items() if author in wanted}
+
+        async for batch in read_entries(self.pool, since):
+            content = {"entries": [entry.to_wire() for entry in batch]}
+            await StreamContent(id=req.id, content=content).send(s)
+        await StreamContent(id=req.id, content={}, is_eos=True).send(s)
+
+    @expose
+    async def push(self, s: RPCStream, req: Request):
+        # {"entries": [...]} -> {"heads": {author: seq}} for feeds that advanced
+        wanted = set(await wanted_authors(self.pool, self.id))
+        entries = [Entry.from_json(entry) for entry in req.args['entries']]
+        progress = await ingest(self.pool, [entry for entry in entries if str(entry.author) in wanted])
+        heads = {author: seq for author, (_, seq) in progress.items()}
+        await Response(id=req.id, content={"heads": heads}).send(s)
+
+
+class Session:
+    # An open sync session with one peer, which can be used for any
+    # number of rounds of fetching and pushing.
+    def __init__(self,
+                 pool: Pool,
+                 id: LocalIdentity,
+                 server_id: Identity,
+                 conn: Connection,
+                 client: RPCClient,
+                 timeout=10):
+        self.pool = pool
+        self.id = id
+        self.server_id = server_id
+        self.conn = conn
+        self.client = client
+        self.timeout = timeout
+        self.wanted = None  # the feeds we last told the peer we want
+        self.shared = set()  # and those of them it wants too
+
+    @classmethod
+    async def open(cls,
+                   pool: Pool,
+                   id: LocalIdentity,
+                   server_id: Identity,
+                   host: str,
+                   port: int,
+                   timeout=10,
+                   tickets: Optional[TicketCache] = None) -> 'Session':
+        # Pass the same tickets to later calls to resume the handshake
+        # with peers seen recently.
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+        conn = Connection(reader, writer)
+        # Reads may idle between rounds, but a peer that stops reading
+        # mustn't leave our writes waiting forever
+        timed = Deadline(conn, timeout=timeout, timed_reads=False)
+        try:
+            box = await asyncio.wait_for(client_handshake(id, server_id, timed, tickets), timeout)
+            s = RPCStream(box)
+            await asyncio.wait_for(negotiate(s, SYNC_OPTIONS), timeout)
+        except BaseException:
+            conn.close()
+            raise
+        client = RPCClient(s)
+        client.start()
+        return cls(pool, id, server_id, conn, client, timeout)
+
+    @property
+    def closed(self) -> bool:
+        return self.client.closed
+
+    async def close(self):
+        try:
+            await self.client.close()
+        finally:
+            self.conn.close()
+
+    async def diff(self) -> Dict[str, Tuple[int, int]]:
+        # author -> (our seq, their seq) for the feeds we want where the
+        # two differ, as far as the peer is willing to share.
+        # Both sides summarise only the feeds they both want, so where
+        # heads agree the walk stops at the root, in one round trip.
+        wanted = set(await wanted_authors(self.pool, str(self.id)))
+        if wanted != self.wanted:
+            await self.share(wanted)
+        try:
+            differ = await self.reconcile()
+        except StaleShare:
+            # The peer's follows changed since we last shared
+            await self.share(wanted)
+            differ = await self.reconcile()
+        ours = {}
+        for author in differ:
+            _, ours[author] = self.pool.heads.get(author)
+        if not ours:
+            return {}
+        theirs = (await self.client.call('peer.heads', {"heads": ours}))['heads']
+        return {a: (ours[a], seq) for a, seq in theirs.items() if a in ours}
+
+    async def share(self, wanted: Set[str]):
+        theirs = await self.client.call('peer.share', {"authors": sorted(wanted)})
+        self.wanted = wanted
+        self.shared = wanted.intersection(theirs['authors'])
+
+    async def reconcile(self) -> Set[str]:
+        # Raises StaleShare if the peer no longer summarises self.shared
+        expected = authors_hash(self.shared)
+
+        async def expand(prefixes):
+            content = await self.client.call('peer.summary', {"prefixes": prefixes})
+            if content['shared'] != expected:
+                raise StaleShare()
+            return content['nodes']
+
+        return await reconcile(heads_summary(self.pool, self.shared), expand)
+
+    async def pull(self, since: Dict[str, int]) -> int:
+        # Fetches everything past since[author], in that order. Raises
+        # asyncio.TimeoutError if the peer goes `timeout` seconds without
+        # sending a frame; what was ingested before that is kept.
+        if not since:
+            return 0
+        count = 0
+        batch = []
+        frames = self.client.stream('peer.fetch', {"since": since})
+        try:
+            while True:
+                try:
+                    content = await asyncio.wait_for(frames.__anext__(), self.timeout)
+                except StopAsyncIteration:
+                    break
+                batch.extend(Entry.from_json(entry) for entry in content['entries'])
+                if len(batch) >= INGEST_BATCH_SIZE:
+                    count += sum(new - old for old, new in (await ingest(self.pool, batch)).values())
+                    batch = []
+        finally:
+            await frames.aclose()
+        if batch:
+            count += sum(new - old for old, new in (await ingest(self.pool, batch)).values())
+        return count
+
+    async def push(self, since: Dict[str, int]) -> int:
+        # Batches go one at a time so that the peer ingests them in order
+        count = 0
+        async for batch in read_entries(self.pool, since):
+            await self.client.call('peer.push', {"entries": [entry.to_wire() for entry in batch]})
+            count += len(batch)
+        return count
+
+
+async def replicate(pool: Pool,
+                    id: LocalIdentity,
+                    server_id: Identity,
+                    host: str,
+                    port: int,
+                    timeout=10,
+                    tickets: Optional[TicketCache] = None) -> Tuple[int, int]:
+    # Runs one sync session against a peer in both directions, returning
+    # how many entries were fetched and how many were pushed.
+    session = await Session.open(pool, id, server_id, host, port, timeout, tickets)
+    try:
+        diff = await session.diff()
+        fetched, pushed = await asyncio.gather(
+            session.pull({a: ours for a, (ours, theirs) in diff.items() if theirs > ours}),
+            session.push({a: theirs for a, (ours, theirs) in diff.items() if theirs < ours}),
+        )
+        return fetched, pushed
+    finally:
+        await session.close()
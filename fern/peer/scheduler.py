@@ -0,0 +1,155 @@
+import time
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from fern.identity import LocalIdentity
+from fern.peer.discovery import Peer, PeerTable
+from fern.peer.replicate import Session
+from fern.proto.handshake import TicketCache
+from fern.store.log import Pool
+
+
+class Scheduler:
+    # Decides which feeds to fetch from which peers. Every `interval`
+    # seconds it tops up to max_sessions open sessions from the peers
+    # that are ready, asks each idle session how far behind we are on
+    # the feeds we follow, and hands every feed to the peer that's
+    # furthest ahead on it. Each session then fetches its feeds, most
+    # behind first, in the background. A feed is claimed by one session
+    # until its fetch finishes, so no range is fetched twice at once.
+    # Sessions stay open across rounds, and are only closed after
+    # idle_rounds rounds with nothing to fetch, or sooner when there are
+    # ready peers waiting for a session.
+    def __init__(self,
+                 pool: Pool,
+                 id: LocalIdentity,
+                 table: PeerTable,
+                 max_sessions=4,
+                 interval=5.0,
+                 idle_rounds=3,
+                 timeout=10,
+                 tickets: Optional[TicketCache] = None):
+        self.pool = pool
+        self.id = id
+        self.table = table
+        self.max_sessions = max_sessions
+        self.interval = interval
+        self.idle_rounds = idle_rounds
+        self.timeout = timeout
+        self.tickets = tickets if tickets is not None else TicketCache()
+        self.sessions: Dict[str, Session] = {}
+        self.fetching: Dict[str, asyncio.Task] = {}  # peer -> fetch in progress
+        self.claims: Dict[str, str] = {}             # author -> peer fetching it
+        self.idle: Dict[str, int] = {}               # peer -> rounds with nothing to fetch
+        self.last_synced: Dict[str, float] = {}
+
+    async def run(self):
+        try:
+            while True:
+                await self.round()
+                await asyncio.sleep(self.interval)
+        finally:
+            await self.close()
+
+    async def close(self):
+        for task in self.fetching.values():
+            task.cancel()
+        await asyncio.gather(*self.fetching.values(), return_exceptions=True)
+        await asyncio.gather(*(self.drop(peer) for peer in list(self.sessions)))
+
+    async def round(self):
+        waiting = await self.connect()
+
+        idle = [peer for peer in self.sessions if peer not in self.fetching]
+        diffs = await asyncio.gather(*(self.diff(peer) for peer in idle))
+
+        # author -> (their seq, our seq, peer) for the peer furthest ahead
+        offers: Dict[str, Tuple[int, int, str]] = {}
+        for peer, diff in zip(idle, diffs):
+            for author, (ours, theirs) in (diff or {}).items():
+                if theirs > ours and author not in self.claims:
+                    if author not in offers or theirs > offers[author][0]:
+                        offers[author] = (theirs, ours, peer)
+
+        work: Dict[str, List[Tuple[int, str, int]]] = {}
+        for author, (theirs, ours, peer) in offers.items():
+            work.setdefault(peer, []).append((theirs - ours, author, ours))
+
+        for peer in idle:
+            if peer not in self.sessions:
+                continue
+            if peer in work:
+                self.idle[peer] = 0
+                # Most behind first
+                since = {author: ours for _, author, ours in sorted(work[peer], reverse=True)}
+                for author in since:
+                    self.claims[author] = peer
+                self.fetching[peer] = asyncio.create_task(self.fetch(peer, since))
+            else:
+                self.idle[peer] = self.idle.get(peer, 0) + 1
+                if self.idle[peer] >= self.idle_rounds or waiting:
+                    await self.drop(peer)
+                    waiting = max(0, waiting - 1)
+
+    async def connect(self) -> int:
+        # Opens sessions with ready peers while there's room, least
+        # recently synced first. Returns how many ready peers are left
+        # without one.
+        candidates = [peer for peer in self.table.ready() if str(peer.id) not in self.sessions]
+        candidates.sort(key=lambda peer: self.last_synced.get(str(peer.id), 0))
+        room = max(0, self.max_sessions - len(self.sessions))
+        await asyncio.gather(*(self.open(peer) for peer in candidates[:room]))
+        return len(candidates[room:])
+
+    async def open(self, peer: Peer):
+        try:
+            session = await Session.open(
+                self.pool, self.id, peer.id, peer.host, peer.port,
+                timeout=self.timeout, tickets=self.tickets,
+            )
+        except Exception:
+            self.table.failed(peer.id)
+            return
+        self.table.succeeded(peer.id)
+        self.sessions[str(peer.id)] = session
+        self.idle[str(peer.id)] = 0
+
+    async def drop(self, peer: str):
+        session = self.sessions.pop(peer, None)
+        self.idle.pop(peer, None)
+        if session is not None:
+            try:
+                await session.close()
+            except Exception:
+                pass
+
+    async def fail(self, peer: str):
+        session = self.sessions.get(peer)
+        # A session the peer closed while idle isn't a failure
+        if session is not None and not session.closed:
+            self.table.failed(session.server_id)
+        await self.drop(peer)
+
+    async def diff(self, peer: str) -> Optional[Dict[str, Tuple[int, int]]]:
+        try:
+            diff = await asyncio.wait_for(self.sessions[peer].diff(), self.timeout)
+        except Exception:
+            await self.fail(peer)
+            return None
+        self.last_synced[peer] = time.monotonic()
+        return diff
+
+    async def fetch(self, peer: str, since: Dict[str, int]):
+        # A peer that stalls mid-stream makes pull time out, which drops
+        # the session and frees its claims for other peers
+        try:
+            await self.sessions[peer].pull(since)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            await self.fail(peer)
+        finally:
+            del self.fetching[peer]
+            for author in since:
+                if self.claims.get(author) == peer:
+                    del self.claims[author]
@@ -0,0 +1,98 @@
+import asyncio
+import logging
+
+from nacl.exceptions import CryptoError
+
+from fern.local.server import LocalRPC
+from fern.peer.replicate import PeerHandler
+from fern.proto.handshake import BadHandshake, get_handshake_pool, server_handshake, TicketCache
+from fern.proto.stream import RPCStream
+from fern.proto.utils import Connection, Deadline, ProtocolError
+
+logger = logging.getLogger(__name__)
+
+
+class PeerRPC(LocalRPC):
+    # Serves replication to other nodes on config.sync_addr. Peers
+    # authenticate through the handshake, then speak the same RPC as
+    # local clients over the encrypted BoxStream.
+    #
+    # Handshake crypto runs in a thread pool, at most max_handshakes at
+    # a time. Connections beyond that wait their turn, and once
+    # max_pending are waiting, new ones are closed straight away rather
+    # than queued up behind a storm.
+    def __init__(self,
+                 config,
+                 handlers=[PeerHandler],
+                 timeout=10,
+                 max_handshakes=8,
+                 max_pending=64,
+                 backlog=128,
+                 executor=None,
+                 **kwargs):
+        super().__init__(config, handlers=handlers, timeout=timeout, **kwargs)
+        self.id = config.get_local_identity()
+        self.tickets = TicketCache()
+        self.executor = executor or get_handshake_pool()
+        self.handshakes = asyncio.Semaphore(max_handshakes)
+        self.max_pending = max_pending
+        self.pending = 0
+        self.backlog = backlog
+
+    async def admit(self) -> bool:
+        if self.pending >= self.max_pending:
+            return False
+        self.pending += 1
+        try:
+            await self.handshakes.acquire()
+        finally:
+            self.pending -= 1
+        return True
+
+    async def handshake(self, conn):
+        try:
+            return await asyncio.wait_for(
+                server_handshake(self.id, conn, self.tickets, self.executor),
+                self.timeout,
+            )
+        finally:
+            self.handshakes.release()
+
+    async def handle(self, reader, writer):
+        with Connection(reader, writer) as conn:
+            if not await self.admit():
+                return
+            try:
+                _, box = await self.handshake(Deadline(conn, timeout=self.timeout, timed_reads=False))
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                return
+            except (BadHandshake, CryptoError) as exc:
+                # Bad keys or signatures from the client. Anyone can send
+                # those, so they're not worth more than a debug line.
+                logger.debug('peer handshake failed: %r', exc)
+                return
+            except Exception as exc:
+                asyncio.get_running_loop().call_exception_handler({
+                    'message': 'peer handshake failed',
+                    'exception': exc,
+                })
+                return
+            try:
+                await self.serve_client(RPCStream(box))
+            except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+                pass
+            except ProtocolError as exc:
+                # Malformed frames from the peer
+                logger.debug('peer sent a malformed frame: %r', exc)
+
+    async def serve(self):
+        host, port = self.config.sync_addr.rsplit(':', 1)
+        async with self.pool:
+            server = await asyncio.start_server(
+                self.handle,
+                host=host or None,
+                port=int(port),
+                backlog=self.backlog,
+            )
+            async with server:
+                await server.serve_forever()
@@ -0,0 +1,188 @@
+import struct
+from typing import Tuple
+
+from fern.proto.utils import ProtocolError
+
+
+# A compact binary encoding for RPC payloads: the subset of MessagePack
+# needed for JSON-like values plus raw bytes, which travel as-is rather
+# than as base64 strings.
+
+# Nesting deeper than this is rejected rather than left to hit the
+# recursion limit (orjson won't encode much deeper either)
+MAX_DEPTH = 256
+
+
+_pack_uint8 = struct.Struct('>BB').pack
+_pack_uint16 = struct.Struct('>BH').pack
+_pack_uint32 = struct.Struct('>BI').pack
+_pack_uint64 = struct.Struct('>BQ').pack
+_pack_int8 = struct.Struct('>Bb').pack
+_pack_int16 = struct.Struct('>Bh').pack
+_pack_int32 = struct.Struct('>Bi').pack
+_pack_int64 = struct.Struct('>Bq').pack
+_pack_float64 = struct.Struct('>Bd').pack
+
+
+def _pack_length(out: bytearray, n: int, fix: int, fix_max: int, tag8, tag16: int, tag32: int):
+    if n <= fix_max:
+        out.append(fix | n)
+    elif tag8 is not None and n <= 0xff:
+        out += _pack_uint8(tag8, n)
+    elif n <= 0xffff:
+        out += _pack_uint16(tag16, n)
+    elif n <= 0xffffffff:
+        out += _pack_uint32(tag32, n)
+    else:
+        raise ProtocolError("value is too long to encode")
+
+
+def _pack(out: bytearray, obj):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj <= 0x7f:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif obj > 0:
+            if obj <= 0xff:
+                out += _pack_uint8(0xcc, obj)
+            elif obj <= 0xffff:
+                out += _pack_uint16(0xcd, obj)
+            elif obj <= 0xffffffff:
+                out += _pack_uint32(0xce, obj)
+            elif obj <= 0xffffffffffffffff:
+                out += _pack_uint64(0xcf, obj)
+            else:
+                raise ProtocolError("integer is too large to encode")
+        else:
+            if obj >= -0x80:
+                out += _pack_int8(0xd0, obj)
+            elif obj >= -0x8000:
+                out += _pack_int16(0xd1, obj)
+            elif obj >= -0x80000000:
+                out += _pack_int32(0xd2, obj)
+            elif obj >= -0x8000000000000000:
+                out += _pack_int64(0xd3, obj)
+            else:
+                raise ProtocolError("integer is too small to encode")
+    elif isinstance(obj, float):
+        out += _pack_float64(0xcb, obj)
+    elif isinstance(obj, str):
+        b = obj.encode('utf-8')
+        _pack_length(out, len(b), 0xa0, 31, 0xd9, 0xda, 0xdb)
+        out += b
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        _pack_length(out, len(obj), 0, -1, 0xc4, 0xc5, 0xc6)
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(out, len(obj), 0x90, 15, None, 0xdc, 0xdd)
+        for item in obj:
+            _pack(out, item)
+    elif isinstance(obj, dict):
+        _pack_length(out, len(obj), 0x80, 15, None, 0xde, 0xdf)
+        for key, value in obj.items():
+            _pack(out, key)
+            _pack(out, value)
+    else:
+        raise TypeError(f"cannot encode {type(obj).__name__}")
+
+
+def pack(obj) -> bytes:
+    out = bytearray()
+    _pack(out, obj)
+    return bytes(out)
+
+
+_unpack_from = {
+    0xca: struct.Struct('>f').unpack_from,
+    0xcb: struct.Struct('>d').unpack_from,
+    0xcc: struct.Struct('>B').unpack_from,
+    0xcd: struct.Struct('>H').unpack_from,
+    0xce: struct.Struct('>I').unpack_from,
+    0xcf: struct.Struct('>Q').unpack_from,
+    0xd0: struct.Struct('>b').unpack_from,
+    0xd1: struct.Struct('>h').unpack_from,
+    0xd2: struct.Struct('>i').unpack_from,
+    0xd3: struct.Struct('>q').unpack_from,
+}
+_scalar_size = {0xca: 4, 0xcb: 8, 0xcc: 1, 0xcd: 2, 0xce: 4, 0xcf: 8, 0xd0: 1, 0xd1: 2, 0xd2: 4, 0xd3: 8}
+# tag -> size of its length prefix, for str, bin, array and map
+_length_size = {
+    0xd9: 1, 0xda: 2, 0xdb: 4,
+    0xc4: 1, 0xc5: 2, 0xc6: 4,
+    0xdc: 2, 0xdd: 4,
+    0xde: 2, 0xdf: 4,
+}
+
+
+def _unpack(b: memoryview, pos: int, depth: int = 0) -> Tuple[object, int]:
+    tag = b[pos]
+    pos += 1
+    if tag <= 0x7f:
+        return tag, pos
+    if tag >= 0xe0:
+        return tag - 0x100, pos
+    if tag == 0xc0:
+        return None, pos
+    if tag == 0xc2:
+        return False, pos
+    if tag == 0xc3:
+        return True, pos
+    if tag in _scalar_size:
+        value, = _unpack_from[tag](b, pos)
+        return value, pos + _scalar_size[tag]
+
+    if 0xa0 <= tag <= 0xbf:
+        kind, n = 'str', tag & 0x1f
+    elif 0x90 <= tag <= 0x9f:
+        kind, n = 'array', tag & 0x0f
+    elif 0x80 <= tag <= 0x8f:
+        kind, n = 'map', tag & 0x0f
+    elif tag in _length_size:
+        size = _length_size[tag]
+        n = int.from_bytes(b[pos:pos + size], byteorder='big')
+        pos += size
+        kind = ('str' if tag in (0xd9, 0xda, 0xdb) else
+                'bin' if tag in (0xc4, 0xc5, 0xc6) else
+                'array' if tag in (0xdc, 0xdd) else
+                'map')
+    else:
+        raise ProtocolError("unsupported type tag 0x%02x" % tag)
+
+    if kind in ('array', 'map'):
+        depth += 1
+        if depth > MAX_DEPTH:
+            raise ProtocolError("binary payload is nested too deeply")
+
+    if kind == 'str':
+        return str(b[pos:pos + n], 'utf-8'), pos + n
+    if kind == 'bin':
+        return bytes(b[pos:pos + n]), pos + n
+    if kind == 'array':
+        items = []
+        for _ in range(n):
+            item, pos = _unpack(b, pos, depth)
+            items.append(item)
+        return items, pos
+    d = {}
+    for _ in range(n):
+        key, pos = _unpack(b, pos, depth)
+        d[key], pos = _unpack(b, pos, depth)
+    return d, pos
+
+
+def unpack(b) -> object:
+    b = memoryview(b)
+    try:
+        obj, pos = _unpack(b, 0)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError) as exc:
+        raise ProtocolError("malformed binary payload") from exc
+    if pos != len(b):
+        raise ProtocolError("trailing bytes after binary payload")
+    return obj
@@ -1,8 +1,13 @@
+import time
+import asyncio
 import nacl.hash
+from collections import OrderedDict
+from concurrent.futures import Executor, ThreadPoolExecutor
+from typing import Optional, Tuple
 from nacl.bindings.crypto_scalarmult import crypto_scalarmult
+from nacl.exceptions import CryptoError
 from nacl.secret import SecretBox
 from nacl.public import PrivateKey, PublicKey
-from nacl.signing import VerifyKey
 from nacl.encoding import RawEncoder
 from fern.identity import Identity, LocalIdentity
 from fern.proto.stream import BoxStream
@@ -16,10 +21,60 @@ def sha256(msg):
     return nacl.hash.sha256(msg, encoder=RawEncoder)
 
 
+class TicketCache:
+    # Resumption tickets, evicted oldest first past max_size and dropped
+    # once they're older than ttl seconds. Clients key tickets by server
+    # id, servers by ticket id.
+    def __init__(self, max_size=1024, ttl=600):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        item = self.entries.get(key)
+        if item is None:
+            return None
+        expires, value = item
+        if time.monotonic() >= expires:
+            del self.entries[key]
+            return None
+        return value
+
+    def pop(self, key):
+        value = self.get(key)
+        self.entries.pop(key, None)
+        return value
+
+
+# After a full handshake both sides derive a ticket from the shared
+# secret. A later connection can present the ticket id instead of msg3,
+# and both sides then key the session off the ticket and a fresh
+# ephemeral exchange: one scalar multiplication each, no signatures.
+# Tickets are single use; every resumed session derives the next one.
+# If the server has lost the ticket, or keeps no tickets at all, it
+# answers with 80 zero bytes, and the client carries on with a full
+# handshake over the same connection.
+RESUME_NONCE = (1).to_bytes(24, byteorder='big')
+REJECT_RESUME = bytes(80)
+
+
+def derive_ticket(secret: bytes) -> Tuple[bytes, bytes]:
+    # (ticket id, ticket secret)
+    ticket_secret = sha256(b'fern ticket' + secret)
+    return sha256(b'fern ticket id' + ticket_secret), ticket_secret
+
+
 async def client_handshake(
     client_id: LocalIdentity,
     server_id: Identity,
     conn,  # Conn should have .read and .write
+    tickets: Optional[TicketCache] = None,
 ) -> BoxStream:
     client_priv = PrivateKey.generate()  # Ephemeral PK
 
@@ -32,7 +87,27 @@ async def client_handshake(
     server_pub = PublicKey(msg2)
 
     ab = crypto_scalarmult(client_priv.encode(), server_pub.encode())
-    aB = crypto_scalarmult(client_priv.encode(), server_id.pub.to_curve25519_public_key().encode())
+
+    ticket = tickets.pop(str(server_id)) if tickets is not None else None
+    if ticket is not None:
+        ticket_id, ticket_secret = ticket
+        sbox = SecretBox(sha256(ticket_secret + ab))
+        msg3 = sbox.encrypt(msg1 + bytes(msg2), nonce=bytes(24))
+        await conn.write(ticket_id + msg3.ciphertext)  # 112 bytes
+
+        msg4 = bytes(await conn.read(80))
+        if msg4 != REJECT_RESUME:
+            if sbox.decrypt(msg4, nonce=RESUME_NONCE) != bytes(msg2) + msg1:
+                raise BadHandshake("server failed to resume")
+            tickets.put(str(server_id), derive_ticket(bytes(sbox)))
+            return BoxStream(
+                sbox,
+                send_nonce=server_pub.encode()[:24],
+                recv_nonce=client_priv.public_key.encode()[:24],
+                conn=conn,
+            )
+
+    aB = crypto_scalarmult(client_priv.encode(), server_id.curve25519_public_key())
 
     # Send our ID
     sig = client_id.priv.sign(server_pub.encode() + sha256(ab)).signature
@@ -43,7 +118,7 @@ async def client_handshake(
     await conn.write(msg3.ciphertext)  # 112 bytes
 
     Ab = crypto_scalarmult(
-        client_id.priv.to_curve25519_private_key().encode(),
+        client_id.curve25519_private_key(),
         server_pub.encode(),
     )
 
@@ -53,6 +128,8 @@ async def client_handshake(
         smessage=sig + client_id.pub.encode() + sha256(ab),
         signature=sbox.decrypt(msg4, nonce=bytes(24)),
     )
+    if tickets is not None:
+        tickets.put(str(server_id), derive_ticket(ab + aB + Ab))
 
     return BoxStream(
         sbox,
@@ -62,27 +139,37 @@ async def client_handshake(
     )
 
 
-async def server_handshake(
-    server_id: LocalIdentity,
-    conn,  # Conn should have .read and .write
-) -> (Identity, BoxStream):
+_handshake_pool = None
+
+
+def get_handshake_pool() -> Executor:
+    global _handshake_pool
+    if _handshake_pool is None:
+        _handshake_pool = ThreadPoolExecutor(thread_name_prefix='handshake')
+    return _handshake_pool
+
+
+def _server_ephemeral(msg1: bytes) -> Tuple[PrivateKey, bytes]:
     server_priv = PrivateKey.generate()  # Ephemeral PK
+    ab = crypto_scalarmult(server_priv.encode(), msg1)
+    return server_priv, ab
 
-    # Recv eph pubkey
-    msg1 = await conn.read(32)
-    client_pub = PublicKey(msg1)
 
-    # Send our eph pubkey
-    msg2 = server_priv.public_key.encode()
-    await conn.write(msg2)  # 32 bytes
+def _server_resume(ticket_secret: bytes, ab: bytes, msg1: bytes, msg2: bytes, msg3: bytes):
+    sbox = SecretBox(sha256(ticket_secret + ab))
+    if sbox.decrypt(msg3[32:], nonce=bytes(24)) != msg1 + msg2:
+        raise BadHandshake("client failed to resume")
+    return sbox, sbox.encrypt(msg2 + msg1, nonce=RESUME_NONCE).ciphertext
+
+
+def _server_open(server_id: LocalIdentity, ab: bytes, msg1: bytes, msg3: bytes) -> Tuple[bytes, bytes]:
+    aB = crypto_scalarmult(server_id.curve25519_private_key(), msg1)
+    return aB, SecretBox(sha256(ab + aB)).decrypt(msg3, nonce=bytes(24))
 
-    ab = crypto_scalarmult(server_priv.encode(), client_pub.encode())
-    aB = crypto_scalarmult(server_id.priv.to_curve25519_private_key().encode(), client_pub.encode())
 
-    msg3 = await conn.read(112)
-    msg3 = SecretBox(sha256(ab + aB)).decrypt(msg3, nonce=bytes(24))
+def _server_accept(server_id: LocalIdentity, server_priv: PrivateKey, ab: bytes, aB: bytes, msg3: bytes):
     sig = msg3[:64]
-    client_id = Identity(VerifyKey(msg3[64:]))
+    client_id = Identity.from_raw_bytes(msg3[64:])
 
     # Verify
     client_id.pub.verify(
@@ -92,22 +179,76 @@ async def server_handshake(
 
     Ab = crypto_scalarmult(
         server_priv.encode(),
-        client_id.pub.to_curve25519_public_key().encode(),
+        client_id.curve25519_public_key(),
     )
 
-    sbox = SecretBox(sha256(ab + aB + Ab))
+    secret = ab + aB + Ab
+    sbox = SecretBox(sha256(secret))
     msg4 = sbox.encrypt(
         server_id.priv.sign(sig + client_id.pub.encode() + sha256(ab)).signature,
         nonce=bytes(24),
     )
-    await conn.write(msg4.ciphertext)  # 80 bytes
+    return client_id, secret, sbox, msg4.ciphertext
+
+
+async def offload(executor: Optional[Executor], fn, *args):
+    if executor is None:
+        return fn(*args)
+    return await asyncio.get_running_loop().run_in_executor(executor, fn, *args)
+
+
+async def server_handshake(
+    server_id: LocalIdentity,
+    conn,  # Conn should have .read and .write
+    tickets: Optional[TicketCache] = None,
+    executor: Optional[Executor] = None,
+) -> (Identity, BoxStream):
+    # With an executor, the crypto runs there (libsodium releases the
+    # GIL, so a thread pool will do) rather than on the event loop.
+
+    # Recv eph pubkey
+    msg1 = bytes(await conn.read(32))
+    server_priv, ab = await offload(executor, _server_ephemeral, msg1)
+
+    # Send our eph pubkey
+    msg2 = server_priv.public_key.encode()
+    await conn.write(msg2)  # 32 bytes
+
+    msg3 = bytes(await conn.read(112))
+
+    ticket = tickets.get(msg3[:32]) if tickets is not None else None
+    if ticket is not None:
+        ticket_secret, client_id = ticket
+        sbox, msg4 = await offload(executor, _server_resume, ticket_secret, ab, msg1, msg2, msg3)
+        await conn.write(msg4)  # 80 bytes
+
+        tickets.pop(msg3[:32])
+        ticket_id, ticket_secret = derive_ticket(bytes(sbox))
+        tickets.put(ticket_id, (ticket_secret, client_id))
+    else:
+        try:
+            aB, msg3 = await offload(executor, _server_open, server_id, ab, msg1, msg3)
+        except CryptoError:
+            # Presumably a ticket we no longer have (or we keep none):
+            # ask for a full handshake. A client whose full handshake we
+            # couldn't open fails on this answer instead.
+            await conn.write(REJECT_RESUME)
+            msg3 = bytes(await conn.read(112))
+            aB, msg3 = await offload(executor, _server_open, server_id, ab, msg1, msg3)
+
+        client_id, secret, sbox, msg4 = await offload(
+            executor, _server_accept, server_id, server_priv, ab, aB, msg3)
+        await conn.write(msg4)  # 80 bytes
+        if tickets is not None:
+            ticket_id, ticket_secret = derive_ticket(secret)
+            tickets.put(ticket_id, (ticket_secret, client_id))
 
     return (
         client_id,
         BoxStream(
             sbox,
-            send_nonce=client_pub.encode()[:24],
-            recv_nonce=server_priv.public_key.encode()[:24],
+            send_nonce=msg1[:24],
+            recv_nonce=msg2[:24],
             conn=conn,
         )
     )
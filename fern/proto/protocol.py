@@ -0,0 +1,195 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Optional, Tuple
+
+from fern.proto.stream import FLAG_CREDIT, RPCStream
+
+
+RawFrame = Tuple[int, int, memoryview]  # (flags, request_id, data)
+
+
+class RPCProtocol(asyncio.Protocol):
+    # RPC transport that parses frames straight out of data_received,
+    # instead of two readexactly calls per frame. Frames that arrive
+    # whole are handed out as memoryviews into the received bytes; only
+    # frames split across reads are assembled in a buffer. Reading is
+    # paused once `max_frames` frames are queued up, and writes wait for
+    # the transport to drain once it is past its high watermark. Credit
+    # frames are applied on arrival and never queued. Since a paused
+    # transport can't take credit either, consumers (like LocalRPC)
+    # must keep reading rather than stop when they are busy.
+    def __init__(self,
+                 on_connect: Optional[Callable[[RPCStream], Awaitable]] = None,
+                 max_frames: int = 64,
+                 high_water: int = 64 * 1024,
+                 low_water: int = 16 * 1024,
+                 timeout: Optional[float] = 2):
+        self.on_connect = on_connect
+        self.max_frames = max_frames
+        self.high_water = high_water
+        self.low_water = low_water
+        self.timeout = timeout
+        self.transport = None
+        self.task = None
+        self.frames = deque()
+        self.partial = None
+        self.reading_paused = False
+        self.read_waiter = None
+        self.write_paused = False
+        self.drain_waiters = []
+        self.closed = False
+        self.corked = 0
+        self.buf = []
+        # Set by RPCStream to take credit frames as soon as they arrive
+        self.on_credit = None
+
+    # asyncio.Protocol
+
+    def connection_made(self, transport):
+        self.transport = transport
+        transport.set_write_buffer_limits(high=self.high_water, low=self.low_water)
+        if self.on_connect is not None:
+            self.task = asyncio.ensure_future(self.on_connect(RPCStream(self)))
+            self.task.add_done_callback(self.on_done)
+
+    def on_done(self, task):
+        self.transport.close()
+        if task.cancelled():
+            return
+        exc = task.exception()
+        if exc is not None and not isinstance(exc, (ConnectionError, asyncio.IncompleteReadError)):
+            asyncio.get_running_loop().call_exception_handler({
+                'message': 'exception while serving RPC connection',
+                'exception': exc,
+                'protocol': self,
+            })
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self.wakeup_reader()
+        for fut in self.drain_waiters:
+            if not fut.done():
+                fut.set_exception(exc or ConnectionResetError('connection lost'))
+        self.drain_waiters.clear()
+
+    def eof_received(self):
+        self.closed = True
+        self.wakeup_reader()
+
+    def pause_writing(self):
+        self.write_paused = True
+
+    def resume_writing(self):
+        self.write_paused = False
+        for fut in self.drain_waiters:
+            if not fut.done():
+                fut.set_result(None)
+        self.drain_waiters.clear()
+
+    def data_received(self, data: bytes):
+        view = memoryview(data)
+        if self.partial is not None:
+            view = self.fill(view)
+            if view is None:
+                return
+
+        pos = 0
+        n = len(view)
+        while n - pos >= 9:
+            length = int.from_bytes(view[pos + 1:pos + 5], byteorder='big')
+            end = pos + 9 + length
+            if end > n:
+                break
+            self.push((view[pos],
+                       int.from_bytes(view[pos + 5:pos + 9], byteorder='big'),
+                       view[pos + 9:end]))
+            pos = end
+
+        if pos < n:
+            self.partial = bytearray(view[pos:])
+        self.wakeup_reader()
+
+    def fill(self, view: memoryview) -> Optional[memoryview]:
+        # Completes a frame split across reads, returning what's left of
+        # `view` once it's whole.
+        buf = self.partial
+        if len(buf) < 9:
+            m = min(9 - len(buf), len(view))
+            buf += view[:m]
+            view = view[m:]
+            if len(buf) < 9:
+                return None
+
+        end = 9 + int.from_bytes(buf[1:5], byteorder='big')
+        m = min(end - len(buf), len(view))
+        buf += view[:m]
+        view = view[m:]
+        if len(buf) < end:
+            return None
+
+        # buf is never touched again, so the view into it stays valid
+        self.partial = None
+        self.push((buf[0],
+                   int.from_bytes(buf[5:9], byteorder='big'),
+                   memoryview(buf)[9:]))
+        return view
+
+    def push(self, frame: RawFrame):
+        if frame[0] & FLAG_CREDIT and self.on_credit is not None:
+            self.on_credit(frame[1], int.from_bytes(frame[2], byteorder='big'))
+            return
+        self.frames.append(frame)
+        if len(self.frames) >= self.max_frames and not self.reading_paused:
+            self.reading_paused = True
+            self.transport.pause_reading()
+
+    def wakeup_reader(self):
+        if self.read_waiter is not None and not self.read_waiter.done():
+            self.read_waiter.set_result(None)
+
+    # Interface used by RPCStream
+
+    async def read_frame(self) -> RawFrame:
+        while not self.frames:
+            if self.closed:
+                raise asyncio.IncompleteReadError(bytes(self.partial or b''), None)
+            self.read_waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self.read_waiter
+            finally:
+                self.read_waiter = None
+
+        frame = self.frames.popleft()
+        if self.reading_paused and len(self.frames) <= self.max_frames // 2:
+            self.reading_paused = False
+            self.transport.resume_reading()
+        return frame
+
+    async def write(self, b: bytes):
+        if self.corked:
+            self.buf.append(b)
+            return
+        if self.closed:
+            raise ConnectionResetError('connection lost')
+        self.transport.write(b)
+        if self.write_paused:
+            fut = asyncio.get_running_loop().create_future()
+            self.drain_waiters.append(fut)
+            try:
+                await asyncio.wait_for(fut, self.timeout)
+            except asyncio.TimeoutError:
+                self.transport.abort()
+                raise
+
+    def cork(self):
+        self.corked += 1
+
+    async def uncork(self):
+        self.corked -= 1
+        if not self.corked and self.buf:
+            b = b''.join(self.buf)
+            self.buf.clear()
+            await self.write(b)
+
+    def abort(self):
+        self.transport.abort()
@@ -1,8 +1,13 @@
+import asyncio
 from dataclasses import dataclass
-from typing import Union
+from typing import AsyncIterator, Tuple, Union
 from fern.proto.stream import RPCStream, RPCFrame
 
 
+class RPCError(Exception):
+    pass
+
+
 @dataclass(frozen=True)
 class Request:
     id: int
@@ -65,3 +70,125 @@ def decode_frame(frame: RPCFrame, is_server: bool) -> Union[Request, StreamConte
             content=frame.data,
             is_error=frame.is_error,
         )
+
+
+async def negotiate(s: RPCStream, offer: dict, request_id: int = 0) -> dict:
+    # Offer connection options (e.g. {"codecs": ["binary"]}) to the server
+    # and apply whatever it accepts. Must be done before any other
+    # request is in flight. Servers that predate negotiation reply with
+    # an error, in which case nothing changes.
+    await Request(id=request_id, name='rpc.options', args=offer).send(s)
+    res = decode_frame(await s.next(), is_server=False)
+    accepted = {} if res.is_error else res.content
+    s.apply_options(accepted)
+    return accepted
+
+
+class RPCClient:
+    # Issues requests over an RPCStream and routes replies back by
+    # request id, so that calls and streams can share one connection.
+    # Stream credit is only handed back as frames are taken off here,
+    # so a slow consumer holds back its own stream and nothing else.
+    def __init__(self, s: RPCStream):
+        self.s = s
+        self.s.auto_credit = False
+        self.last_id = 0
+        self.pending = {}
+        self.reading = None
+
+    def start(self):
+        self.reading = asyncio.ensure_future(self.read_loop())
+
+    @property
+    def closed(self) -> bool:
+        return self.reading is None or self.reading.done()
+
+    async def close(self):
+        try:
+            if not self.closed:
+                await self.s.goodbye()
+        finally:
+            self.reading.cancel()
+            await asyncio.gather(self.reading, return_exceptions=True)
+
+    async def __aenter__(self):
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def read_loop(self):
+        try:
+            while True:
+                frame = await self.s.next()
+                if not frame.alive:
+                    break
+                q = self.pending.get(frame.request_id)
+                if q is not None:
+                    q.put_nowait(decode_frame(frame, is_server=False))
+        finally:
+            # Wake up everyone still waiting on a reply
+            for q in self.pending.values():
+                q.put_nowait(None)
+
+    async def request(self, name: str, args: dict) -> Tuple[int, asyncio.Queue]:
+        if self.closed:
+            raise ConnectionResetError('connection lost')
+        self.last_id += 1
+        request_id = self.last_id
+        q = self.pending[request_id] = asyncio.Queue()
+        await Request(id=request_id, name=name, args=args).send(self.s)
+        return request_id, q
+
+    @staticmethod
+    async def reply(q: asyncio.Queue) -> Union[StreamContent, Response]:
+        item = await q.get()
+        if item is None:
+            raise ConnectionResetError('connection lost')
+        if item.is_error:
+            raise RPCError(item.content)
+        return item
+
+    async def call(self, name: str, args: dict):
+        request_id, q = await self.request(name, args)
+        try:
+            return (await self.reply(q)).content
+        finally:
+            del self.pending[request_id]
+
+    def stream(self, name: str, args: dict) -> 'Stream':
+        return Stream(self, name, args)
+
+
+class Stream:
+    # Iterates over the content of each frame of a stream reply. Once
+    # it's done, `eos` holds the content of the end-of-stream frame, e.g.
+    # {"seq": ...} from feed.history to resume from.
+    def __init__(self, client: RPCClient, name: str, args: dict):
+        self.eos = None
+        self.frames = self.read(client, name, args)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self.frames.__anext__()
+
+    def aclose(self):
+        return self.frames.aclose()
+
+    async def read(self, client: RPCClient, name: str, args: dict) -> AsyncIterator:
+        request_id, q = await client.request(name, args)
+        try:
+            while True:
+                item = await client.reply(q)
+                if isinstance(item, StreamContent):
+                    await client.s.consume_credit(request_id, item.is_eos)
+                    if item.is_eos:
+                        self.eos = item.content
+                        return
+                yield item.content
+        finally:
+            del client.pending[request_id]
+            client.s.consumed.pop(request_id, None)
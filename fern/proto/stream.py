@@ -1,71 +1,143 @@
+import asyncio
 import orjson
-from collections import namedtuple
+import zlib
+from collections import deque, namedtuple
 from nacl.secret import SecretBox
 from fern.proto.utils import ProtocolError
+from fern.entry import json_default
+from fern.proto.codec import pack, unpack
 
+try:
+    from nacl.bindings import (
+        crypto_secretbox_easy as secretbox_seal,
+        crypto_secretbox_open_easy as secretbox_open,
+    )
+except ImportError:  # PyNaCl < 1.6
+    from nacl.bindings import (
+        crypto_secretbox as secretbox_seal,
+        crypto_secretbox_open as secretbox_open,
+    )
 
-MAX = 2**(24 * 8) - 1
 
+MAX = 2**(24 * 8) - 1
 
-def increment(x: bytes):
-    u = int.from_bytes(x, byteorder="big")
-    u += 1
-    try:
-        return u.to_bytes(24, byteorder="big")
-    except OverflowError:
-        return (u & MAX).to_bytes(24, byteorder="big")
+# The 2 byte header limits the size of a box; receivers accept any size
+# up to this, so the sender is free to pick smaller ones.
+MAX_BOX_SIZE = 2**16 - 1
 
 
 class BoxStream:
-    def __init__(self, sbox: SecretBox, send_nonce: bytes, recv_nonce: bytes, conn):
+    def __init__(self,
+                 sbox: SecretBox,
+                 send_nonce: bytes,
+                 recv_nonce: bytes,
+                 conn,
+                 max_box_size: int = MAX_BOX_SIZE):
+        if not 0 < max_box_size <= MAX_BOX_SIZE:
+            raise ValueError("max_box_size must be within 1 and %d" % MAX_BOX_SIZE)
         self.conn = conn
-        self.sbox = sbox
-        self.send_nonce = send_nonce
-        self.recv_nonce = recv_nonce
-        self.buf = b''
+        self.max_box_size = max_box_size
+        # Boxes are sealed with the raw bindings rather than through
+        # SecretBox, and nonces are kept as integers: this avoids building
+        # an EncryptedMessage and round-tripping the nonce through
+        # int.from_bytes for every box.
+        self.key = bytes(sbox)
+        self.send_nonce = int.from_bytes(send_nonce, byteorder='big')
+        self.recv_nonce = int.from_bytes(recv_nonce, byteorder='big')
+        # Decrypted frames not yet consumed by read(), and how far into
+        # the first one we are.
+        self.chunks = deque()
+        self.offset = 0
+        self.buffered = 0
+        # Plaintext queued up by write() while a flush is in progress
+        self.outgoing = []
+        self.flushing = None
 
-    def increment_send(self):
-        self.send_nonce = increment(self.send_nonce)
-        return self.send_nonce
+    def increment_send(self) -> bytes:
+        self.send_nonce = (self.send_nonce + 1) & MAX
+        return self.send_nonce.to_bytes(24, byteorder='big')
 
-    def increment_recv(self):
-        self.recv_nonce = increment(self.recv_nonce)
-        return self.recv_nonce
+    def increment_recv(self) -> bytes:
+        self.recv_nonce = (self.recv_nonce + 1) & MAX
+        return self.recv_nonce.to_bytes(24, byteorder='big')
 
-    async def write(self, b: bytes):
-        n = len(b)
-        b = memoryview(b)
-        while n > 0:
-            m = min(n, 4096)
+    def seal(self, b: bytes) -> bytes:
+        key = self.key
+        boxes = []
+        for i in range(0, len(b), self.max_box_size):
+            body = b[i:i + self.max_box_size]
             # 2 byte header for length
-            head = m.to_bytes(2, byteorder='big')
-            body = b[:m]
-            shead = self.sbox.encrypt(head, nonce=self.increment_send())
-            sbody = self.sbox.encrypt(body, nonce=self.increment_send())
-            await self.conn.write(shead.ciphertext + sbody.ciphertext)
-            n -= m
-            b = b[m:]
+            head = len(body).to_bytes(2, byteorder='big')
+            boxes.append(secretbox_seal(head, self.increment_send(), key))
+            boxes.append(secretbox_seal(body, self.increment_send(), key))
+        return b''.join(boxes)
+
+    async def write(self, b: bytes):
+        # Every write is queued synchronously, so concurrent writers never
+        # interleave. Writes queued together are sealed into the same
+        # boxes and sent with a single write to the underlying connection.
+        self.outgoing.append(b)
+        if self.flushing is None:
+            self.flushing = asyncio.ensure_future(self.flush())
+        await asyncio.shield(self.flushing)
+
+    async def flush(self):
+        try:
+            while self.outgoing:
+                b = b''.join(self.outgoing)
+                self.outgoing.clear()
+                await self.conn.write(self.seal(b))
+        finally:
+            self.flushing = None
 
     async def next_frame(self):
-        header = self.sbox.decrypt(
-            await self.conn.read(18),
-            nonce=self.increment_recv(),
+        header = secretbox_open(
+            bytes(await self.conn.read(18)),
+            self.increment_recv(),
+            self.key,
         )
         length = int.from_bytes(header, byteorder='big')
-        return self.sbox.decrypt(
-            await self.conn.read(16 + length),
-            nonce=self.increment_recv(),
+        return secretbox_open(
+            bytes(await self.conn.read(16 + length)),
+            self.increment_recv(),
+            self.key,
         )
 
-    async def read(self, n):
-        # Read enough information
-        while len(self.buf) < n:
-            self.buf += await self.next_frame()
-        b = self.buf[:n]
-        self.buf = self.buf[n:]
-        return b
+    async def read(self, n) -> memoryview:
+        while self.buffered < n:
+            frame = await self.next_frame()
+            self.chunks.append(frame)
+            self.buffered += len(frame)
+        self.buffered -= n
+
+        # Fast path: the bytes lie within a single frame
+        chunk = self.chunks[0]
+        start = self.offset
+        if len(chunk) - start >= n:
+            self.consume(chunk, n)
+            return memoryview(chunk)[start:start + n]
+
+        b = bytearray(n)
+        pos = 0
+        while pos < n:
+            chunk = self.chunks[0]
+            start = self.offset
+            m = min(len(chunk) - start, n - pos)
+            b[pos:pos + m] = memoryview(chunk)[start:start + m]
+            self.consume(chunk, m)
+            pos += m
+        return memoryview(b)
+
+    def consume(self, chunk: bytes, n: int):
+        self.offset += n
+        if self.offset == len(chunk):
+            self.chunks.popleft()
+            self.offset = 0
 
 
+FLAG_CREDIT = 0b01000000
+FLAG_COMPRESSED = 0b00100000
+FLAG_BINARY = 0b00010000
 FLAG_JSON = 0b00001000
 FLAG_STREAM = 0b00000100
 FLAG_ERR = 0b00000010
@@ -77,12 +149,98 @@ GOODBYE_FRAME = RPCFrame(alive=False, request_id=None, data=None, is_error=False
 
 
 class RPCStream:
+    # Several requests may be answered concurrently. Frames never
+    # interleave since each one is handed to conn.write in one call, and
+    # both Connection and BoxStream queue a write before suspending.
+
+    # Once zlib compression is negotiated, payloads of at least this many
+    # bytes are compressed. Compressed payloads are never inflated past
+    # max_decompressed, whatever the peer claims.
+    compress_threshold = 1024
+    compress_level = 1
+    max_decompressed = 16 * 1024 * 1024
+    # Largest per-stream window (in frames) we'll agree to
+    max_window = 1024
+    # How many bytes of stream frames to gather into one write
+    max_write = 64 * 1024
+
     def __init__(self, conn):
         self.conn = conn
+        # Framed transports (see fern.proto.protocol) parse frames
+        # themselves; byte streams are read a header at a time.
+        self.read_frame = getattr(conn, 'read_frame', self.read_stream_frame)
+        # Payload codec used for sending, see select_options(). Frames
+        # are always decoded according to their flags.
+        self.binary = False
+        self.compress = False
+
+        # Flow control, once a window has been negotiated: each side may
+        # have at most `window` unacknowledged stream frames in flight per
+        # request id, and the receiver hands out more credit as frames
+        # are consumed. Outgoing stream frames are queued per request id
+        # and written round-robin by a single task, so one long stream
+        # can't hold up the others. Other frames are written directly,
+        # unless their request id still has stream frames queued.
+        self.window = None
+        self.credit = {}      # request id -> frames we may still send
+        self.queued = {}      # request id -> deque of (frame, is_eos)
+        self.ready = deque()  # ids with frames queued and credit left
+        self.waiters = {}     # request id -> sender waiting on queue space
+        self.blocked = asyncio.Event()  # set while there are any waiters
+        self.consumed = {}    # request id -> frames received since we last granted
+        self.writing = None
+        self.write_error = None
+        # Whether next() grants credit for stream frames itself, or the
+        # caller does so through consume_credit() once it's done with them
+        self.auto_credit = True
+        # Transports that parse frames can apply credit as it arrives,
+        # even while nobody is reading.
+        if hasattr(conn, 'on_credit'):
+            conn.on_credit = self.add_credit
+
+    def select_options(self, offer: dict) -> dict:
+        # Pick what we support out of the options offered by the peer
+        accepted = {}
+        if 'binary' in offer.get('codecs', ()):
+            accepted['codec'] = 'binary'
+        if 'zlib' in offer.get('compression', ()):
+            accepted['compression'] = 'zlib'
+        window = offer.get('window')
+        if isinstance(window, int) and window > 0:
+            accepted['window'] = min(window, self.max_window)
+        return accepted
+
+    def apply_options(self, accepted: dict):
+        self.binary = accepted.get('codec') == 'binary'
+        self.compress = accepted.get('compression') == 'zlib'
+        self.window = accepted.get('window')
+
+    def decompress(self, data) -> bytes:
+        d = zlib.decompressobj()
+        try:
+            out = d.decompress(data, self.max_decompressed)
+        except zlib.error as exc:
+            raise ProtocolError("invalid compressed payload") from exc
+        if d.unconsumed_tail:
+            raise ProtocolError("decompressed payload is too large")
+        if not d.eof:
+            raise ProtocolError("truncated compressed payload")
+        return out
 
     async def goodbye(self):
         await self.conn.write((0).to_bytes(9, byteorder="big"))
 
+    def cork(self):
+        # Hold back frames until uncork() where the connection supports it.
+        # With flow control the stream writer batches frames itself, and
+        # corking could hold back frames the peer needs to grant credit.
+        if self.window is None and hasattr(self.conn, 'cork'):
+            self.conn.cork()
+
+    async def uncork(self):
+        if self.window is None and hasattr(self.conn, 'uncork'):
+            await self.conn.uncork()
+
     async def send(self,
                    request_id: int,
                    data: object,
@@ -90,18 +248,26 @@ class RPCStream:
                    is_eos: bool = False,
                    is_stream: bool = False):
 
-        is_json = False
+        flags = 0
         if not isinstance(data, bytes):
-            is_json = True
-            data = orjson.dumps(data)
+            if self.binary:
+                flags |= FLAG_BINARY
+                data = pack(data)
+            else:
+                flags |= FLAG_JSON
+                data = orjson.dumps(data, default=json_default)
+
+        if self.compress and len(data) >= self.compress_threshold:
+            compressed = zlib.compress(data, self.compress_level)
+            if len(compressed) < len(data):
+                flags |= FLAG_COMPRESSED
+                data = compressed
 
         if len(data) > 2**32 - 1:
             raise ProtocolError("length is too long")
 
-        flags = 0
         flags |= FLAG_ERR if is_error else 0
         flags |= FLAG_EOS if is_eos else 0
-        flags |= FLAG_JSON if is_json else 0
         flags |= FLAG_STREAM if is_stream else 0
 
         header = (
@@ -110,19 +276,115 @@ class RPCStream:
             request_id.to_bytes(4, byteorder="big")
         )
         # header is 9 bytes
-        await self.conn.write(header + data)
+        if self.window is not None and (is_stream or request_id in self.queued):
+            # Anything else for a stream that's still queued, like an
+            # error response, goes after its frames and ends the stream
+            await self.queue_frame(request_id, header + data, is_eos or not is_stream)
+        else:
+            await self.conn.write(header + data)
 
-    async def next(self) -> RPCFrame:
+    async def queue_frame(self, request_id: int, frame: bytes, is_eos: bool):
+        if self.write_error is not None:
+            raise self.write_error
+        q = self.queued.get(request_id)
+        if q is None:
+            q = self.queued[request_id] = deque()
+            self.credit[request_id] = self.window
+        while len(q) >= self.window:
+            waiter = self.waiters[request_id] = asyncio.get_running_loop().create_future()
+            self.blocked.set()
+            try:
+                await waiter
+            finally:
+                self.waiters.pop(request_id, None)
+                if not self.waiters:
+                    self.blocked.clear()
+        q.append((frame, is_eos))
+        if len(q) == 1 and self.credit[request_id] > 0:
+            self.ready.append(request_id)
+            self.kick()
+
+    def add_credit(self, request_id: int, n: int):
+        # Credit for a stream we've finished (or never started) is stale
+        if request_id not in self.credit:
+            return
+        self.credit[request_id] += n
+        if self.credit[request_id] == n and self.queued[request_id]:
+            self.ready.append(request_id)
+            self.kick()
+
+    def kick(self):
+        if self.writing is None:
+            self.writing = asyncio.ensure_future(self.write_streams())
+
+    async def write_streams(self):
+        try:
+            while self.ready:
+                batch = []
+                size = 0
+                # One frame per ready stream per round
+                while self.ready and size < self.max_write:
+                    request_id = self.ready.popleft()
+                    q = self.queued[request_id]
+                    frame, is_eos = q.popleft()
+                    batch.append(frame)
+                    size += len(frame)
+                    if is_eos:
+                        del self.queued[request_id]
+                        del self.credit[request_id]
+                    else:
+                        self.credit[request_id] -= 1
+                        if q and self.credit[request_id] > 0:
+                            self.ready.append(request_id)
+                    waiter = self.waiters.get(request_id)
+                    if waiter is not None and not waiter.done():
+                        waiter.set_result(None)
+                await self.conn.write(b''.join(batch))
+        except Exception as exc:
+            self.write_error = exc
+            for waiter in self.waiters.values():
+                if not waiter.done():
+                    waiter.set_exception(exc)
+        finally:
+            self.writing = None
+
+    async def grant(self, request_id: int, n: int):
+        header = (
+            FLAG_CREDIT.to_bytes(1, byteorder="big") +
+            (4).to_bytes(4, byteorder="big") +
+            request_id.to_bytes(4, byteorder="big")
+        )
+        await self.conn.write(header + n.to_bytes(4, byteorder="big"))
+
+    async def read_stream_frame(self):
         header = await self.conn.read(9)
         flags = header[0]
         length = int.from_bytes(header[1:5], byteorder="big")
         req_id = int.from_bytes(header[5:], byteorder="big")
 
         if length == 0:
+            return flags, req_id, b''
+        return flags, req_id, await self.conn.read(length)
+
+    async def next(self) -> RPCFrame:
+        flags, req_id, data = await self.read_frame()
+        while flags & FLAG_CREDIT:
+            self.add_credit(req_id, int.from_bytes(data, byteorder="big"))
+            flags, req_id, data = await self.read_frame()
+        if len(data) == 0:
             return GOODBYE_FRAME
 
-        data = await self.conn.read(length)
-        data = orjson.loads(data) if flags & FLAG_JSON else data
+        if flags & FLAG_STREAM and self.auto_credit:
+            await self.consume_credit(req_id, bool(flags & FLAG_EOS))
+
+        if flags & FLAG_COMPRESSED:
+            data = self.decompress(data)
+        if flags & FLAG_BINARY:
+            data = unpack(data)
+        elif flags & FLAG_JSON:
+            data = orjson.loads(data)
+        else:
+            data = bytes(data)
 
         return RPCFrame(alive=True,
                         request_id=req_id,
@@ -130,3 +392,17 @@ class RPCStream:
                         is_error=bool(flags & FLAG_ERR),
                         is_stream=bool(flags & FLAG_STREAM),
                         is_eos=bool(flags & FLAG_EOS))
+
+    async def consume_credit(self, request_id: int, is_eos: bool):
+        # Hand back credit in batches of half the window
+        if self.window is None:
+            return
+        if is_eos:
+            self.consumed.pop(request_id, None)
+            return
+        n = self.consumed.get(request_id, 0) + 1
+        if n >= max(1, self.window // 2):
+            self.consumed[request_id] = 0
+            await self.grant(request_id, n)
+        else:
+            self.consumed[request_id] = n
@@ -4,34 +4,115 @@ import asyncio
 class Connection:
     def __init__(self,
                  reader: asyncio.StreamReader,
-                 writer: asyncio.StreamWriter):
+                 writer: asyncio.StreamWriter,
+                 high_water: int = 64 * 1024,
+                 low_water: int = 16 * 1024):
         self.r = reader
         self.w = writer
+        self.high_water = high_water
+        writer.transport.set_write_buffer_limits(high=high_water, low=low_water)
+        # While corked, writes are buffered here until uncork()
+        self.corked = 0
+        self.buf = []
 
     async def read(self, n):
         return await self.r.readexactly(n)
 
     async def write(self, b):
+        if self.corked:
+            self.buf.append(b)
+            return
         self.w.write(b)
-        await self.w.drain()
+        # Only wait for the transport once it's past the high watermark
+        if self.w.transport.get_write_buffer_size() > self.high_water:
+            await self.w.drain()
+
+    def cork(self):
+        self.corked += 1
+
+    async def uncork(self):
+        self.corked -= 1
+        if not self.corked and self.buf:
+            b = b''.join(self.buf)
+            self.buf.clear()
+            await self.write(b)
+
+    def abort(self):
+        self.w.transport.abort()
 
     def __enter__(self):
         return self
 
-    def __exit__(self, *exc):
+    def close(self):
         self.w.close()
 
+    def __exit__(self, *exc):
+        self.close()
+
 
 class Deadline:
-    def __init__(self, conn, timeout=2):
+    # Fails the connection if a read or write makes no progress within
+    # `timeout` seconds. Rather than a wait_for around every call, one
+    # timer per connection is pushed back lazily whenever an operation
+    # completes, and the connection is aborted when it runs out.
+    def __init__(self, conn, timeout=2, timed_reads=True):
         self.conn = conn
         self.timeout = timeout
+        self.timed_reads = timed_reads
+        self.pending = 0
+        self.last_progress = 0
+        self.timer = None
+        self.expired = False
+
+    def check(self):
+        self.timer = None
+        if not self.pending:
+            return
+        loop = asyncio.get_running_loop()
+        deadline = self.last_progress + self.timeout
+        if loop.time() < deadline:
+            self.timer = loop.call_at(deadline, self.check)
+            return
+        self.expired = True
+        self.conn.abort()
+
+    async def timed(self, aw):
+        if self.expired:
+            aw.close()
+            raise asyncio.TimeoutError
+        loop = asyncio.get_running_loop()
+        if not self.pending:
+            # Time spent with nothing in flight doesn't count
+            self.last_progress = loop.time()
+        self.pending += 1
+        if self.timer is None:
+            self.timer = loop.call_at(self.last_progress + self.timeout, self.check)
+        try:
+            return await aw
+        except (ConnectionError, asyncio.IncompleteReadError) as exc:
+            if self.expired:
+                raise asyncio.TimeoutError from exc
+            raise
+        finally:
+            self.pending -= 1
+            self.last_progress = loop.time()
 
     async def read(self, n):
-        return await asyncio.wait_for(self.conn.read(n), self.timeout)
+        if not self.timed_reads:
+            return await self.conn.read(n)
+        return await self.timed(self.conn.read(n))
 
     async def write(self, b):
-        await asyncio.wait_for(self.conn.write(b), self.timeout)
+        await self.timed(self.conn.write(b))
+
+    def cork(self):
+        self.conn.cork()
+
+    async def uncork(self):
+        await self.timed(self.conn.uncork())
+
+    def abort(self):
+        self.conn.abort()
 
 
 class ProtocolError(Exception):
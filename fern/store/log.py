@@ -1,44 +1,350 @@
+import asyncio
 import orjson
 from aiosqlite import Connection, connect
 
 from contextlib import asynccontextmanager
-from typing import Tuple
-from fern.entry import Entry
+from typing import Dict, List, Optional, Tuple, Union
+from fern.entry import Entry, canonical_encode_json
 from fern.identity import Identity
+from fern.store.summary import Summary
 
 
-SCHEMA = '''
-CREATE TABLE IF NOT EXISTS log (
-    id        CHAR(45) NOT NULL,
+SCHEMA_VERSION = 3
+
+LOG_SCHEMA = '''
+CREATE TABLE log (
+    id        CHAR(45) NOT NULL PRIMARY KEY,
     prev      CHAR(45),
     author    CHAR(45) NOT NULL,
-    seq       INTEGER,
+    seq       INTEGER NOT NULL,
     timestamp INTEGER NOT NULL,
     type      VARCHAR NOT NULL,
-    data      BLOB,
-    sig       CHAR(88),
+    ctype     INTEGER NOT NULL,
+    data      BLOB NOT NULL,
+    sig       CHAR(88) NOT NULL,
     UNIQUE(author, seq)
-)
+);
+CREATE INDEX log_author_type ON log (author, type);
+CREATE INDEX log_timestamp ON log (timestamp);
+'''
+
+HEADS_SCHEMA = '''
+CREATE TABLE heads (
+    author CHAR(45) NOT NULL PRIMARY KEY,
+    id     CHAR(45) NOT NULL,
+    seq    INTEGER NOT NULL
+);
 '''
 
+FOLLOWS_SCHEMA = '''
+CREATE TABLE follows (
+    author    CHAR(45) NOT NULL,
+    target    CHAR(45) NOT NULL,
+    since_seq INTEGER NOT NULL,
+    PRIMARY KEY (author, target)
+) WITHOUT ROWID;
+'''
+
+SCHEMA = LOG_SCHEMA + HEADS_SCHEMA + FOLLOWS_SCHEMA
+
+# Content types of the data column
+DATA_BYTES = 0
+DATA_JSON = 1
+
+PRAGMAS = (
+    'PRAGMA journal_mode = WAL',
+    'PRAGMA synchronous = NORMAL',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA mmap_size = 268435456',
+)
+
+STATEMENT_CACHE_SIZE = 256
+MIGRATION_BATCH_SIZE = 1024
+QUERY_BATCH_SIZE = 512
+
+FOLLOW_TYPES = ('follow', 'unfollow')
+
 
 def get_db(path: str) -> Connection:
-    return connect(path)
+    return connect(path, cached_statements=STATEMENT_CACHE_SIZE)
+
+
+def dump_data(data: Union[bytes, dict]) -> Tuple[int, bytes]:
+    if isinstance(data, bytes):
+        return DATA_BYTES, data
+    return DATA_JSON, canonical_encode_json(data)
+
+
+def load_data(ctype: int, data: bytes) -> Union[bytes, dict]:
+    if ctype == DATA_JSON:
+        return orjson.loads(data)
+    return data
+
+
+async def execute_script(db: Connection, script: str):
+    # Unlike executescript, this doesn't commit the open transaction
+    for statement in script.split(';'):
+        if statement.strip():
+            await db.execute(statement)
+
+
+async def get_schema_version(db: Connection) -> int:
+    cursor = await db.execute('PRAGMA user_version')
+    (version,), = await cursor.fetchall()
+    if version == 0:
+        # Logs from before versioning have a log table but no version
+        cursor = await db.execute(
+            "SELECT EXISTS (SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'log')"
+        )
+        (exists,), = await cursor.fetchall()
+        version = 1 if exists else 0
+    return version
 
 
 async def init_db(db: Connection):
-    await db.execute(SCHEMA)
-    await db.commit()
+    version = await get_schema_version(db)
+    if version == SCHEMA_VERSION:
+        return
+    if version > SCHEMA_VERSION:
+        raise ValueError(f"log schema version {version} is newer than {SCHEMA_VERSION}")
+
+    async with transaction(db):
+        await db.execute('BEGIN')
+        if version == 0:
+            await execute_script(db, SCHEMA)
+        else:
+            for v in range(version, SCHEMA_VERSION):
+                await MIGRATIONS[v](db)
+        await db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+
+async def migrate_v1(db: Connection):
+    # v1 stored data as orjson.dumps(Entry.encode_data(data)), i.e. JSON
+    # with bytes as a quoted base64 string, and had no id key or indexes.
+    # Copy the log over in batches so the whole thing is never in memory.
+    await db.execute('ALTER TABLE log RENAME TO log_v1')
+    await db.execute('DROP TABLE IF EXISTS heads')
+    await execute_script(db, LOG_SCHEMA + HEADS_SCHEMA)
+
+    cursor = await db.execute(
+        'SELECT id, prev, author, seq, timestamp, type, data, sig FROM log_v1'
+    )
+    while True:
+        rows = await cursor.fetchmany(MIGRATION_BATCH_SIZE)
+        if not rows:
+            break
+        await db.executemany(
+            'INSERT INTO log (id, prev, author, seq, timestamp, type, ctype, data, sig) VALUES '
+            '(?,?,?,?,?,?,?,?,?)',
+            [(id, prev, author, seq, timestamp, type,
+              *dump_data(Entry.decode_data(orjson.loads(data))),
+              sig)
+             for id, prev, author, seq, timestamp, type, data, sig in rows],
+        )
+    await db.execute('DROP TABLE log_v1')
+    await rebuild_heads(db)
+
+
+async def migrate_v2(db: Connection):
+    await execute_script(db, FOLLOWS_SCHEMA)
+    cursor = await db.execute(
+        'SELECT author, seq, type, ctype, data FROM log '
+        "WHERE type = 'follow' OR type = 'unfollow' ORDER BY author, seq"
+    )
+    while True:
+        rows = await cursor.fetchmany(MIGRATION_BATCH_SIZE)
+        if not rows:
+            break
+        # Decoded as store_entries sees it, so JSON data is skipped
+        for author, seq, type, ctype, data in rows:
+            await update_follows(db, author, seq, type, load_data(ctype, data))
+
+
+MIGRATIONS = {
+    1: migrate_v1,
+    2: migrate_v2,
+}
+
+
+async def rebuild_heads(db: Connection):
+    cursor = await db.execute(
+        'SELECT id, author, seq FROM log ORDER BY author, seq',
+    )
+    heads = {}
+    async for id, author, seq in cursor:
+        if author not in heads:
+            if seq == 1:
+                heads[author] = (id, seq)
+            continue
+        _, prev_seq = heads[author]
+        if prev_seq == seq - 1:
+            heads[author] = (id, seq)
+
+    await db.execute('DELETE FROM heads')
+    await db.executemany(
+        'INSERT INTO heads (author, id, seq) VALUES (?,?,?)',
+        [(author, id, seq) for author, (id, seq) in heads.items()],
+    )
+
+
+class HeadIndex:
+    # In-memory mirror of the heads table: author -> (id, seq) of the
+    # last entry in the contiguous chain starting at seq 1. Writers stage
+    # changes while their transaction is open; they only become visible
+    # through get() once transaction() commits.
+    def __init__(self):
+        self.heads = {}
+        self.staged = {}
+        self.summary = Summary()
+
+    async def load(self, db: Connection):
+        cursor = await db.execute('SELECT author, id, seq FROM heads')
+        self.heads = {author: (id, seq) async for author, id, seq in cursor}
+        self.staged.clear()
+        self.summary = Summary()
+        for author, (_, seq) in self.heads.items():
+            self.summary.update(author, 0, seq)
+
+    def get(self, author: str) -> Tuple[Optional[str], int]:
+        return self.heads.get(author, (None, 0))
+
+    def get_staged(self, author: str) -> Tuple[Optional[str], int]:
+        return self.staged.get(author) or self.get(author)
+
+    def stage(self, entry: Entry) -> bool:
+        author = str(entry.author)
+        _, seq = self.get_staged(author)
+        if entry.sequence != seq + 1:
+            return False
+        self.staged[author] = (entry.id, entry.sequence)
+        return True
+
+    def commit(self):
+        for author, (_, seq) in self.staged.items():
+            self.summary.update(author, self.get(author)[1], seq)
+        self.heads.update(self.staged)
+        self.staged.clear()
+
+    def rollback(self):
+        self.staged.clear()
+
+    def digest(self) -> Dict[str, str]:
+        return {author: id for author, (id, _) in self.heads.items()}
+
+
+class Pool:
+    # One writer connection shared by everyone (serialised with a lock),
+    # plus a fixed set of reader connections. WAL mode lets the readers
+    # proceed while the writer holds a transaction open. A pool can be
+    # shared by several servers; it stays open until the last one exits.
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.size = 0 if path == ':memory:' else readers
+        self.users = 0
+        self.write_db = None
+        self.heads = HeadIndex()
+        self.write_lock = asyncio.Lock()
+        self.readers = asyncio.Queue()
+
+    async def connect(self, query_only: bool) -> Connection:
+        db = await get_db(self.path)
+        for pragma in PRAGMAS:
+            await db.execute(pragma)
+        if query_only:
+            await db.execute('PRAGMA query_only = 1')
+        return db
+
+    async def open(self):
+        self.write_db = await self.connect(query_only=False)
+        await init_db(self.write_db)
+        await self.heads.load(self.write_db)
+        for _ in range(self.size):
+            self.readers.put_nowait(await self.connect(query_only=True))
+
+    async def close(self):
+        for _ in range(self.size):
+            await (await self.readers.get()).close()
+        if self.write_db is not None:
+            await self.write_db.close()
+            self.write_db = None
+
+    async def __aenter__(self):
+        self.users += 1
+        if self.users == 1:
+            try:
+                await self.open()
+            except Exception:
+                self.users -= 1
+                raise
+        return self
+
+    async def __aexit__(self, *exc):
+        self.users -= 1
+        if not self.users:
+            await self.close()
+
+    @asynccontextmanager
+    async def writer(self):
+        async with self.write_lock:
+            try:
+                yield self.write_db
+            finally:
+                # Never hand the shared writer on mid-transaction, or the
+                # next user would commit whatever was left behind
+                if self.write_db.in_transaction:
+                    self.heads.rollback()
+                    await finish(self.write_db.rollback())
+
+    @asynccontextmanager
+    async def reader(self):
+        # In-memory databases can't be shared between connections
+        if not self.size:
+            yield self.write_db
+            return
+        db = await self.readers.get()
+        try:
+            yield db
+        finally:
+            self.readers.put_nowait(db)
+
+
+async def finish(aw) -> bool:
+    # Runs aw to completion even if we're cancelled meanwhile, so that a
+    # commit or rollback is never abandoned halfway. Returns whether we
+    # were cancelled, for the caller to re-raise once it's safe.
+    task = asyncio.ensure_future(aw)
+    cancelled = False
+    while True:
+        try:
+            await asyncio.shield(task)
+            return cancelled
+        except asyncio.CancelledError:
+            if task.cancelled():
+                raise
+            cancelled = True
 
 
 @asynccontextmanager
-async def transaction(db: Connection):
+async def transaction(db: Connection, heads: Optional[HeadIndex] = None):
+    # Rolls back on cancellation too, not just on errors
     try:
         yield db
-        await db.commit()
-    except Exception as exc:
-        await db.rollback()
-        raise exc
+    except BaseException:
+        if heads is not None:
+            heads.rollback()
+        await finish(db.rollback())
+        raise
+    try:
+        cancelled = await finish(db.commit())
+    except Exception:
+        if heads is not None:
+            heads.rollback()
+        await finish(db.rollback())
+        raise
+    if heads is not None:
+        heads.commit()
+    if cancelled:
+        raise asyncio.CancelledError
 
 
 async def get_last_entry_info(
@@ -56,17 +362,147 @@ async def get_last_entry_info(
     return id, seq
 
 
-async def store_entry(db: Connection, entry: Entry):
-    # assume that entry is verified
-    await db.execute(
-        'INSERT INTO log (id, prev, author, seq, timestamp, type, data, sig) VALUES '
-        '(?,?,?,?,?,?,?,?)',
-        (entry.id,
-         entry.previous,
-         str(entry.author),
-         entry.sequence,
-         entry.timestamp,
-         entry.type,
-         orjson.dumps(Entry.encode_data(entry.data)),
-         entry.signature),
+def entry_row(entry: Entry) -> tuple:
+    return (entry.id,
+            entry.previous,
+            str(entry.author),
+            entry.sequence,
+            entry.timestamp,
+            entry.type,
+            *dump_data(entry.data),
+            entry.signature)
+
+
+async def store_entries(db: Connection, entries: List[Entry], heads: Optional[HeadIndex] = None):
+    # assume that entries are verified
+    await db.executemany(
+        'INSERT INTO log (id, prev, author, seq, timestamp, type, ctype, data, sig) VALUES '
+        '(?,?,?,?,?,?,?,?,?)',
+        [entry_row(entry) for entry in entries],
     )
+    # Only advance a head if the entry extends the contiguous chain
+    await db.executemany(
+        'INSERT INTO heads (author, id, seq) SELECT :author, :id, :seq '
+        'WHERE :seq = 1 OR EXISTS '
+        '(SELECT 1 FROM heads WHERE author = :author AND seq = :seq - 1) '
+        'ON CONFLICT (author) DO UPDATE SET id = excluded.id, seq = excluded.seq',
+        [{"author": str(entry.author), "id": entry.id, "seq": entry.sequence}
+         for entry in entries],
+    )
+    for entry in entries:
+        if entry.type in FOLLOW_TYPES:
+            await update_follows(db, str(entry.author), entry.sequence, entry.type, entry.data)
+    if heads is not None:
+        for entry in entries:
+            heads.stage(entry)
+
+
+ENTRY_COLUMNS = 'id, prev, author, seq, timestamp, type, ctype, data, sig'
+
+
+def row_to_entry(row: tuple) -> Entry:
+    id, prev, author, seq, timestamp, type, ctype, data, sig = row
+    return Entry(
+        id=id,
+        previous=prev,
+        author=Identity.from_id(author),
+        sequence=seq,
+        timestamp=timestamp,
+        type=type,
+        data=load_data(ctype, data),
+        signature=sig,
+    )
+
+
+async def get_entries(
+    db: Connection,
+    author: str,
+    since: int,
+    limit: int,
+    type: Optional[str] = None,
+) -> List[Entry]:
+    # Entries of `author` with seq > since, in seq order
+    if type is None:
+        cursor = await db.execute(
+            f'SELECT {ENTRY_COLUMNS} FROM log WHERE author = ? AND seq > ? '
+            'ORDER BY seq LIMIT ?',
+            (author, since, limit),
+        )
+    else:
+        cursor = await db.execute(
+            f'SELECT {ENTRY_COLUMNS} FROM log WHERE author = ? AND type = ? AND seq > ? '
+            'ORDER BY seq LIMIT ?',
+            (author, type, since, limit),
+        )
+    return [row_to_entry(row) for row in await cursor.fetchall()]
+
+
+async def update_follows(db: Connection, author: str, seq: int, type: str, data):
+    if not isinstance(data, bytes):
+        return
+    target = data.decode('ascii', errors='replace')
+    if type == 'follow':
+        await db.execute(
+            'INSERT INTO follows (author, target, since_seq) VALUES (?,?,?) '
+            'ON CONFLICT (author, target) DO UPDATE SET since_seq = excluded.since_seq',
+            (author, target, seq),
+        )
+    elif type == 'unfollow':
+        await db.execute(
+            'DELETE FROM follows WHERE author = ? AND target = ?',
+            (author, target),
+        )
+
+
+async def get_follows(db: Connection, authors: List[str]) -> Dict[str, List[str]]:
+    follows = {author: [] for author in authors}
+    authors = list(follows)
+    for i in range(0, len(authors), QUERY_BATCH_SIZE):
+        batch = authors[i:i + QUERY_BATCH_SIZE]
+        cursor = await db.execute(
+            'SELECT author, target FROM follows WHERE author IN (%s) ORDER BY author, since_seq'
+            % ','.join('?' * len(batch)),
+            batch,
+        )
+        async for author, target in cursor:
+            follows[author].append(target)
+    return follows
+
+
+async def store_entry(db: Connection, entry: Entry, heads: Optional[HeadIndex] = None):
+    await store_entries(db, [entry], heads)
+
+
+async def ingest_entries(
+    db: Connection,
+    entries: List[Entry],
+    heads: HeadIndex,
+) -> Dict[str, Tuple[int, int]]:
+    # Assume that entries are verified. Entries are checked against each
+    # author's current head: anything at or below the head is skipped as
+    # a duplicate, and an author's run stops at the first entry that
+    # doesn't extend the chain. Call within transaction(db, heads).
+    # Returns author -> (old seq, new seq) for every feed that advanced.
+    runs = {}
+    for entry in entries:
+        runs.setdefault(str(entry.author), []).append(entry)
+
+    accepted = []
+    progress = {}
+    for author, run in runs.items():
+        run.sort(key=lambda entry: entry.sequence)
+        previous, seq = heads.get_staged(author)
+        start = seq
+        for entry in run:
+            if entry.sequence <= seq:
+                continue
+            if entry.sequence != seq + 1 or entry.previous != previous:
+                break
+            accepted.append(entry)
+            previous, seq = entry.id, entry.sequence
+        if seq > start:
+            progress[author] = (start, seq)
+
+    if accepted:
+        await store_entries(db, accepted, heads)
+    return progress
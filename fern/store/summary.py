@@ -0,0 +1,85 @@
+import hashlib
+from typing import Awaitable, Callable, Dict, List, Set, Union
+
+
+# Authors are spread over 16**SUMMARY_DEPTH buckets by a hash of their
+# id. Every node of the tree above the buckets is the XOR of the hashes
+# of the (author, seq) heads beneath it, so a head moving only touches
+# one node per level.
+SUMMARY_DEPTH = 3
+HEX = '0123456789abcdef'
+
+# Most prefixes a peer may ask us to expand at once
+MAX_PREFIXES = 4096
+
+
+def author_path(author: str) -> str:
+    return hashlib.blake2b(author.encode('utf-8'), digest_size=8).hexdigest()[:SUMMARY_DEPTH]
+
+
+def head_hash(author: str, seq: int) -> int:
+    h = hashlib.blake2b(b'%s:%d' % (author.encode('utf-8'), seq), digest_size=8)
+    return int.from_bytes(h.digest(), byteorder='big')
+
+
+class Summary:
+    def __init__(self):
+        self.nodes = {}    # prefix -> XOR of head hashes beneath
+        self.buckets = {}  # full prefix -> {author: seq}
+
+    def update(self, author: str, old_seq: int, new_seq: int):
+        path = author_path(author)
+        delta = head_hash(author, new_seq)
+        if old_seq:
+            delta ^= head_hash(author, old_seq)
+        for i in range(SUMMARY_DEPTH + 1):
+            self.nodes[path[:i]] = self.nodes.get(path[:i], 0) ^ delta
+        self.buckets.setdefault(path, {})[author] = new_seq
+
+    def root(self) -> int:
+        return self.nodes.get('', 0)
+
+    def expand(self, prefixes: List[str]) -> Dict[str, Union[List[int], Dict[str, int]]]:
+        # prefix -> the hashes of its 16 children, or for a bucket, the
+        # heads within it.
+        assert len(prefixes) <= MAX_PREFIXES
+        out = {}
+        for prefix in prefixes:
+            assert len(prefix) <= SUMMARY_DEPTH and all(c in HEX for c in prefix)
+            if len(prefix) < SUMMARY_DEPTH:
+                out[prefix] = [self.nodes.get(prefix + c, 0) for c in HEX]
+            else:
+                out[prefix] = self.buckets.get(prefix, {})
+        return out
+
+
+async def reconcile(summary: Summary,
+                    expand: Callable[[List[str]], Awaitable[dict]]) -> Set[str]:
+    # Walks down both trees from the root, only into the subtrees whose
+    # hashes differ, using `expand` to get the remote side's nodes (i.e.
+    # a remote Summary.expand). Takes SUMMARY_DEPTH + 1 round trips at
+    # most, each proportional to the number of differing subtrees.
+    # Returns the authors whose heads differ.
+    differ = set()
+    prefixes = ['']
+    while prefixes:
+        theirs = await expand(prefixes)
+        ours = summary.expand(prefixes)
+        next_prefixes = []
+        for prefix in prefixes:
+            remote, local = theirs.get(prefix), ours[prefix]
+            if isinstance(local, list):
+                next_prefixes.extend(
+                    prefix + c
+                    for c, a, b in zip(HEX, local, remote or ())
+                    if a != b
+                )
+            else:
+                remote = remote or {}
+                differ.update(
+                    author
+                    for author in local.keys() | remote.keys()
+                    if local.get(author) != remote.get(author)
+                )
+        prefixes = next_prefixes
+    return differ
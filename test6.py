@@ -0,0 +1,59 @@
+import os
+import asyncio
+import tempfile
+from fern.config import Config
+from fern.identity import LocalIdentity
+from fern.local.feed import FeedHandler
+from fern.peer.replicate import replicate
+from fern.peer.server import PeerRPC
+from fern.proto.handshake import TicketCache
+from fern.store.log import Pool
+
+
+# Two nodes on loopback that follow each other. Both post, then node a
+# syncs with node b, which moves entries in both directions.
+
+def make_config(dir, name, port):
+    secret_path = os.path.join(dir, name + '.priv')
+    with open(secret_path, 'wb') as f:
+        f.write(LocalIdentity.generate().to_priv_bytes())
+    return Config(
+        secret_path=secret_path,
+        log_path=os.path.join(dir, name + '.sqlite'),
+        local_tcp_addr="localhost:0",
+        sync_addr="127.0.0.1:%d" % port,
+        broadcast_addr="127.255.255.255:9219",
+    )
+
+
+async def post(feed, n, text):
+    await asyncio.gather(*(feed.appends.append('post', b'%s %d' % (text, i)) for i in range(n)))
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as dir:
+        a, b = make_config(dir, 'a', 8991), make_config(dir, 'b', 8992)
+        a_id, b_id = a.get_local_identity(), b.get_local_identity()
+
+        async with Pool(a.log_path) as a_pool, Pool(b.log_path) as b_pool:
+            a_feed, b_feed = FeedHandler(a, a_pool), FeedHandler(b, b_pool)
+            await a_feed.appends.append('follow', str(b_id).encode('utf-8'))
+            await b_feed.appends.append('follow', str(a_id).encode('utf-8'))
+            await post(a_feed, 1000, b'from a')
+            await post(b_feed, 5000, b'from b')
+
+            server = asyncio.create_task(PeerRPC(b, pool=b_pool).serve())
+            await asyncio.sleep(0.1)
+            # The second session resumes the handshake with the ticket
+            # from the first
+            tickets = TicketCache()
+            fetched, pushed = await replicate(a_pool, a_id, b_id.to_identity(), '127.0.0.1', 8992, tickets=tickets)
+            print('fetched', fetched, 'pushed', pushed)
+            print(a_pool.heads.get(str(b_id)), b_pool.heads.get(str(a_id)))
+            print(await replicate(a_pool, a_id, b_id.to_identity(), '127.0.0.1', 8992, tickets=tickets))
+            server.cancel()
+            await asyncio.gather(server, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
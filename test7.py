@@ -0,0 +1,109 @@
+import asyncio
+from fern.identity import LocalIdentity
+from fern.proto.handshake import (client_handshake, get_handshake_pool, server_handshake,
+                                  REJECT_RESUME, TicketCache)
+from fern.proto.stream import RPCStream
+from fern.proto.utils import Connection
+
+
+# Handshake resumption over loopback: a first full handshake, a resumed
+# one, a replayed (already used) ticket, a server that has lost its
+# tickets and one that keeps none. The last three must fall back to a
+# full handshake on the same connection. Fails with an AssertionError
+# if anything is off.
+
+PORT = 8994
+
+
+class Recorder:
+    # Remembers whether the server asked the client to start over
+    def __init__(self, conn):
+        self.conn = conn
+        self.rejected = False
+
+    async def read(self, n):
+        return await self.conn.read(n)
+
+    async def write(self, b):
+        if b == REJECT_RESUME:
+            self.rejected = True
+        await self.conn.write(b)
+
+
+async def main():
+    server_id, client_id = LocalIdentity.generate(), LocalIdentity.generate()
+    server_tickets, client_tickets = TicketCache(), TicketCache()
+    rejected = []
+    # Set to None to have the server keep no tickets
+    server = {"tickets": server_tickets}
+
+    async def handle(reader, writer):
+        with Connection(reader, writer) as conn:
+            recorder = Recorder(conn)
+            id, box = await server_handshake(server_id, recorder, server["tickets"], get_handshake_pool())
+            rejected.append(recorder.rejected)
+            assert str(id) == str(client_id)
+            s = RPCStream(box)
+            f = await s.next()
+            await s.send(f.request_id, {"echo": f.data})
+
+    async def connect(tickets):
+        reader, writer = await asyncio.open_connection('127.0.0.1', PORT)
+        with Connection(reader, writer) as conn:
+            box = await client_handshake(client_id, server_id.to_identity(), conn, tickets)
+            s = RPCStream(box)
+            await s.send(1, {"hello": "world"})
+            assert (await s.next()).data == {"echo": {"hello": "world"}}
+
+    async with await asyncio.start_server(handle, '127.0.0.1', PORT):
+        key = str(server_id.to_identity())
+
+        # Full handshake: both sides keep a ticket
+        await connect(client_tickets)
+        assert rejected == [False]
+        assert client_tickets.get(key) is not None
+        assert len(server_tickets.entries) == 1
+        print('full handshake ok')
+
+        # Resumed: the ticket is used up and replaced on both sides
+        ticket = client_tickets.get(key)
+        await connect(client_tickets)
+        assert rejected == [False, False]
+        assert client_tickets.get(key) not in (None, ticket)
+        assert server_tickets.get(ticket[0]) is None
+        assert len(server_tickets.entries) == 1
+        print('resume ok')
+
+        # Replaying the used ticket: the server rejects it, and the
+        # client completes a full handshake instead
+        replay = TicketCache()
+        replay.put(key, ticket)
+        await connect(replay)
+        assert rejected[-1] is True
+        assert replay.get(key) not in (None, ticket)
+        print('replayed ticket falls back ok')
+
+        # Server restarted without its tickets: same fallback
+        server_tickets.entries.clear()
+        await connect(client_tickets)
+        assert rejected[-1] is True
+        assert client_tickets.get(key) is not None
+        assert len(server_tickets.entries) == 1
+        print('lost ticket falls back ok')
+
+        # And the new ticket resumes again
+        await connect(client_tickets)
+        assert rejected[-1] is False
+        print('resume after fallback ok')
+
+        # Server keeping no tickets: same fallback
+        server["tickets"] = None
+        ticket = client_tickets.get(key)
+        await connect(client_tickets)
+        assert rejected[-1] is True
+        assert client_tickets.get(key) not in (None, ticket)
+        print('server without tickets falls back ok')
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,126 @@
+import asyncio
+import tempfile
+from fern.local.feed import FeedHandler
+from fern.peer.replicate import Session
+from fern.peer.server import PeerRPC
+from fern.store.log import Pool
+from test6 import make_config, post
+
+
+# Two nodes that follow each other and each follow someone the other
+# doesn't: b follows c and holds c's feed, a follows d and holds d's.
+# Once synced, a round must be a single summary round trip with an
+# empty diff, however the follow sets differ. Fails with an
+# AssertionError if anything is off.
+
+
+class Counter:
+    # Counts calls made through a session's client, by name
+    def __init__(self, client):
+        self.client = client
+        self.calls = []
+
+    async def call(self, name, args):
+        self.calls.append(name)
+        return await self.client.call(name, args)
+
+    def stream(self, name, args):
+        self.calls.append(name)
+        return self.client.stream(name, args)
+
+    async def close(self):
+        await self.client.close()
+
+    @property
+    def closed(self):
+        return self.client.closed
+
+
+async def sync(session):
+    diff = await session.diff()
+    await asyncio.gather(
+        session.pull({a: ours for a, (ours, theirs) in diff.items() if theirs > ours}),
+        session.push({a: theirs for a, (ours, theirs) in diff.items() if theirs < ours}),
+    )
+    return diff
+
+
+async def main():
+    with tempfile.TemporaryDirectory() as dir:
+        a, b, c, d = (make_config(dir, name, 8995) for name in 'abcd')
+        a_id, b_id, c_id, d_id = (x.get_local_identity() for x in (a, b, c, d))
+
+        async with Pool(a.log_path) as a_pool, Pool(b.log_path) as b_pool, \
+                Pool(c.log_path) as c_pool, Pool(d.log_path) as d_pool:
+            a_feed, b_feed = FeedHandler(a, a_pool), FeedHandler(b, b_pool)
+            c_feed, d_feed = FeedHandler(c, c_pool), FeedHandler(d, d_pool)
+            for feed, ids in ((a_feed, (b_id, d_id)), (b_feed, (a_id, c_id))):
+                for id in ids:
+                    await feed.appends.append('follow', str(id).encode('utf-8'))
+            await post(a_feed, 10, b'from a')
+            await post(b_feed, 10, b'from b')
+            await post(c_feed, 10, b'from c')
+            await post(d_feed, 10, b'from d')
+
+            # b gets c's feed, and a gets d's, from their own servers
+            for pool, id, config, peer_pool in ((b_pool, b_id, c, c_pool), (a_pool, a_id, d, d_pool)):
+                server = asyncio.create_task(PeerRPC(config, pool=peer_pool).serve())
+                await asyncio.sleep(0.1)
+                session = await Session.open(pool, id, config.get_local_identity().to_identity(), '127.0.0.1', 8995)
+                await sync(session)
+                await session.close()
+                server.cancel()
+                await asyncio.gather(server, return_exceptions=True)
+            assert b_pool.heads.get(str(c_id))[1] == 10
+            assert a_pool.heads.get(str(d_id))[1] == 10
+
+            server = asyncio.create_task(PeerRPC(b, pool=b_pool).serve())
+            await asyncio.sleep(0.1)
+            session = await Session.open(a_pool, a_id, b_id.to_identity(), '127.0.0.1', 8995)
+            session.client = counter = Counter(session.client)
+            try:
+                # First round: we share our follows and sync a and b only
+                await sync(session)
+                assert counter.calls[0] == 'peer.share'
+                assert a_pool.heads.get(str(b_id)) == b_pool.heads.get(str(b_id))
+                assert a_pool.heads.get(str(a_id)) == b_pool.heads.get(str(a_id))
+                assert a_pool.heads.get(str(c_id))[1] == 0
+                assert b_pool.heads.get(str(d_id))[1] == 0
+                print('first round ok')
+
+                # Nothing changed: one summary call at the root
+                counter.calls.clear()
+                assert await sync(session) == {}
+                assert counter.calls == ['peer.summary'], counter.calls
+                print('unchanged round is one round trip ok')
+
+                # New posts on a shared feed are found, and c's, which
+                # only b wants, make no difference
+                _, before = b_pool.heads.get(str(b_id))
+                await post(b_feed, 3, b'more from b')
+                await post(c_feed, 3, b'more from c')
+                counter.calls.clear()
+                assert await sync(session) == {str(b_id): (before, before + 3)}
+                assert 'peer.share' not in counter.calls
+                print('changed round ok')
+
+                # b unfollowing a: the stale share is noticed and redone,
+                # and a's new posts are no longer offered
+                _, before = b_pool.heads.get(str(b_id))
+                await b_feed.appends.append('unfollow', str(a_id).encode('utf-8'))
+                await post(a_feed, 3, b'more from a')
+                counter.calls.clear()
+                assert await sync(session) == {str(b_id): (before, before + 1)}
+                assert counter.calls[:3] == ['peer.summary', 'peer.share', 'peer.summary'], counter.calls
+                counter.calls.clear()
+                assert await sync(session) == {}
+                assert counter.calls == ['peer.summary'], counter.calls
+                print('peer changing its follows ok')
+            finally:
+                await session.close()
+                server.cancel()
+                await asyncio.gather(server, return_exceptions=True)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())